@@ -2,18 +2,37 @@ import os
 import math
 import pygame
 from lava.primitives import *
-from lava.media import MediaManager
+from lava.physics import gravitate, accelerate
+from lava.levels import body_indices
 
-mediaman = MediaManager()
+# Ship control bits, combined into Ship.controls
+THRUST = 1
+REVERSE = 2
+LEFT = 4
+RIGHT = 8
+FIRE = 16
+
+# Collision layers. A sprite's mask is the layers it tests against when
+# it looks for collisions, see World.detect_collision()
+SHIP_LAYER = 1
+TORPEDO_LAYER = 2
+STAR_LAYER = 4
 
 class Star(GLSprite):
+    __slots__ = ('gravityEffect',)
+    image = 'sun.png'
+    # Pull per ms on a body at the star's surface
+    gravity = 0.15 / 1000
+    can_die = False
+    to_hit = 32000
+    layer = STAR_LAYER
+    mask = SHIP_LAYER | TORPEDO_LAYER
+
     def __init__(self, world, startx, starty):
         GLSprite.__init__(self)
         self.gravityEffect = world.g_collision
-        self.can_die = False
-        self.to_hit = 32000
 
-        self.load_texture(mediaman.load_image('sun.png', 'images'))
+        self.load_texture(self.image, 'images')
         self.width = self.height = 50
         self.radius = 19
         
@@ -29,33 +48,114 @@ class Star(GLSprite):
         self.y += (self.vy / 4) * interval
 
     def gravitate(self, interval):
-        for sprite in self.gravityEffect.iterate_sprites():
-            rad = self.radius * self.scale
-            # Get vector: from self to sprite
-            vector = (sprite.x - self.x, sprite.y - self.y)
-            # Find radian angle of vector, reverse direction
-            angle = math.atan2(vector[1], vector[0]) - math.pi
-            # Get distance, adjust for self's radius
-            distance = math.sqrt(vector[0] ** 2 + vector[1] ** 2) - rad
-            if distance > 0:
-                r = distance / 200 + 1
-                # Gravity calculation
-                force = 0.15 / 1000 / (r ** 2) * interval
-            else:
-                force = 0.0
-            (gx, gy) = sincos(angle, force)
-            sprite.vx += gx
-            sprite.vy += gy
+        gravitate([self], self.gravityEffect, interval)
+
+
+class Obstacle(object):
+    """ One of a level's static bodies, which don't get a sprite each,
+        standing in for it when something hits it
+        """
+    __slots__ = ('index', 'x', 'y', 'scaled_radius', 'gravity')
+    name = "obstacle"
+    layer = STAR_LAYER
+
+    def __init__(self, body, index):
+        (self.x, self.y, self.scaled_radius, self.gravity) = body
+        self.index = index
+
+    def alive(self):
+        return True
+
+
+class BodyField(GLSprite):
+    """ All of a level's static bodies, from asteroids (no gravity) to
+        gravity wells, in arrays indexed by cell.
+
+        Gravity and collisions only look at the bodies in the cells around
+        the sprites moving among them, so a step costs what the local
+        density does, not what the size of the field does, and the whole
+        field draws in one batch.
+        """
+    __slots__ = ('bodies', 'wells', 'cutoff', 'batch', 'vertices')
+    image = Star.image
+    layer = STAR_LAYER
+    mask = SHIP_LAYER | TORPEDO_LAYER
+    can_die = False
+    # Drawn width of a body per unit of radius, as for a Star
+    width_per_radius = 50.0 / 19
+
+    def __init__(self, size, static_bodies):
+        GLSprite.__init__(self)
+        self.name = "bodies"
+        self.facing = 0.0
+        self.load_texture(self.image, 'images')
+
+        (self.bodies, self.wells) = body_indices(static_bodies, size)
+        # Distance from a well's surface beyond which it doesn't pull
+        self.cutoff = float(static_bodies.get('cutoff', 120))
+        # They never move, so neither do their quads
+        bodies = self.bodies.bodies
+        sizes = bodies[:, 2] * self.width_per_radius
+        self.batch = SpriteBatch()
+        self.vertices = self.batch.vertices(bodies[:, 0], bodies[:, 1],
+                                            numpy.zeros(len(bodies)),
+                                            numpy.ones(len(bodies)), sizes, sizes)
+
+    def gravitate(self, bodies, interval):
+        bodies = list(bodies)
+        if not bodies or not len(self.wells.bodies):
+            return
+
+        targets = numpy.array([(body.x, body.y) for body in bodies])
+        (ax, ay) = self.wells.acceleration(targets[:, 0], targets[:, 1], self.cutoff)
+        accelerate(bodies, ax * interval, ay * interval)
+
+    def hits(self, sprites):
+        """ (Obstacle, sprite) for a body each of sprites touched
+            on its way from its last collision pass, see World.sweep()
+            """
+        sprites = [sprite for sprite in sprites if sprite.layer & self.mask]
+        if not sprites:
+            return []
+
+        moves = numpy.array([(sprite.x, sprite.y, sprite.scaled_radius,
+                              sprite.sweep_dx, sprite.sweep_dy) for sprite in sprites])
+        (points, bodies) = self.bodies.touching(*moves.T)
+        hits = []
+        seen = set()
+        for point, body in zip(points.tolist(), bodies.tolist()):
+            if point not in seen:
+                seen.add(point)
+                hits.append((Obstacle(self.bodies.bodies[body].tolist(), body),
+                             sprites[point]))
+        return hits
+
+    def draw(self):
+        if len(self.vertices):
+            self.batch.submit(textures.get(self.texture), self.vertices)
 
     
 class Ship(GLSprite):
+    __slots__ = ('world', 'turn', 'controls', 'life', 'gun_ready',
+                 'last_fired', 'score')
+    # Movement
+    accel = 0.15 / 1000.0
+    maxspeed = 0.3
+    turn_rate = 0.2
+    # Hits it takes, and ms between shots
+    max_life = 3
+    fire_rate = 400
+    can_die = True
+    layer = SHIP_LAYER
+    # Stars find the ships that fly into them
+    mask = SHIP_LAYER | TORPEDO_LAYER
+
     def __init__(self, world, name = "Unknown", image = 'ship.png'):
         GLSprite.__init__(self)
-        self.can_die = True
         self.world = world
         self.name = name
         
-        self.load_texture(mediaman.load_image(image, 'images'))
+        self.load_texture(image, 'images')
         self.width = self.height = 40
         self.radius = 18
 
@@ -66,16 +166,12 @@ class Ship(GLSprite):
         self.vx = 0.0
         self.vy = 0.0
 
-        # Movement attributes
-        self.accel = 0.15 / 1000.0
-        self.maxspeed = 0.3
-        self.turn_rate = 0.2
         self.turn = 0
+        self.controls = 0
 
         # Ship attributes
-        self.life = 3
+        self.life = self.max_life
         self.gun_ready = True
-        self.fire_rate = 400
         self.last_fired = 0
         self.score = 0
 
@@ -86,7 +182,7 @@ class Ship(GLSprite):
         self.facing %= 360
         
         if not self.gun_ready:
-            ticks = pygame.time.get_ticks()
+            ticks = self.world.time
             if ticks - self.last_fired > self.fire_rate:
                self.gun_ready = True
 
@@ -97,10 +193,10 @@ class Ship(GLSprite):
         if not self.alive():
             return None
             
-        self.last_fired = pygame.time.get_ticks()
+        self.last_fired = self.world.time
         self.gun_ready = False
 
-        Torpedo(self)
+        return self.world.torpedoes.fire(self)
         
     def thrust(self, interval):
         radian = math.radians(self.facing + 90)
@@ -146,17 +242,33 @@ class Ship(GLSprite):
 
 
 class Torpedo(GLSprite):
-    def __init__(self, parent):
+    __slots__ = ('pool', 'parent', 'life')
+    speed = 0.3
+    # Time to live, and how long before it can hit the ship that fired it
+    lifetime = 1500
+    arm_time = 150
+    to_hit = 1
+    can_die = True
+    layer = TORPEDO_LAYER
+
+    def __init__(self, pool = None):
         GLSprite.__init__(self)
-        self.parent = parent
+        self.pool = pool
+        self.parent = None
         self.name = "torpedo"
-        self.can_die = True
-        self.to_hit = 1
         
-        self.load_texture(mediaman.load_image('torpedo.png', 'images'))
+        self.load_texture('torpedo.png', 'images')
         
         self.width = self.height = 6
         self.radius = 4
+        self.facing = 0.0
+        self.life = 0
+        self.vx = 0.0
+        self.vy = 0.0
+
+    def launch(self, parent):
+        self.parent = parent
+        self.ignore = parent
 
         # Starting position
         self.facing = parent.facing
@@ -167,11 +279,12 @@ class Torpedo(GLSprite):
         self.y = parent.y + sy
 
         # Velocity and TTL
-        speed = 0.3
-        self.life = 1500
-        (tx, ty) = sincos(angle, speed)
+        self.life = self.lifetime
+        (tx, ty) = sincos(angle, self.speed)
         self.vx = parent.vx + tx
         self.vy = parent.vy + ty
+        # A fresh flight, swept from here rather than from the last one
+        parent.world.start_sweep(self)
 
         # Add to world
         parent.world.g_render.add(self)
@@ -181,6 +294,50 @@ class Torpedo(GLSprite):
         self.x += self.vx * interval
         self.y += self.vy * interval
         self.life -= interval
+        if self.ignore is not None and self.life <= self.lifetime - self.arm_time:
+            self.ignore = None
         
         if self.life <= 0:
             self.kill()
+
+    def kill(self):
+        if self.alive():
+            GLSprite.kill(self)
+            if self.pool is not None:
+                self.pool.release(self)
+
+
+class TorpedoPool(object):
+    """ Preallocated torpedoes for one world.
+
+        Firing launches an idle torpedo and expiry hands it back, so a
+        firefight doesn't build or garbage-collect sprites. The pool only
+        grows, by doubling, if every torpedo is in flight at once.
+        """
+    def __init__(self, capacity = 64):
+        self.torpedoes = []
+        self.idle = []
+        self.grow(capacity)
+
+    def grow(self, count):
+        torpedoes = [Torpedo(self) for x in range(count)]
+        self.torpedoes.extend(torpedoes)
+        self.idle.extend(torpedoes)
+
+    def fire(self, parent):
+        if not self.idle:
+            self.grow(len(self.torpedoes))
+        torpedo = self.idle.pop()
+        torpedo.launch(parent)
+        return torpedo
+
+    def release(self, torpedo):
+        torpedo.parent = None
+        torpedo.ignore = None
+        self.idle.append(torpedo)
+
+    def reset(self):
+        """ Take back every torpedo, for after the world's groups were emptied """
+        for torpedo in self.torpedoes:
+            torpedo.parent = None
+        self.idle = list(self.torpedoes)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+""" Play large batches of headless matches across a process pool.
+
+Each match is a World on its own level with its own seed, ship count,
+controllers and class attribute overrides, such as Ship.accel or
+Star.gravity, for tuning the game's balance. A match runs until a ship
+wins or is knocked out and the next level is loaded, or until --max-ticks
+steps pass without a result, which counts as a draw.
+
+Matches come from a plan file with one JSON object per line:
+
+    {"level": "level2", "seed": 7, "ships": 4, "bots": 4,
+     "overrides": {"Ship.fire_rate": 300, "Torpedo.speed": 0.4}}
+
+or are laid out from the command line, every combination of the --set
+values on every level, --matches times each:
+
+    python batch.py level1 level2 --matches 100 --set Ship.accel=0.0001,0.0002
+
+Results are written as JSON lines in the order matches finish: the
+winner, the scores, the simulated duration and the ticks per second.
+Workers are replaced every --tasks-per-worker matches, which bounds how
+much memory any one of them can build up.
+"""
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import multiprocessing
+from actors import Quiet, Ship, Torpedo, Star
+from world import World, SEEDS, match_seed
+from bots import BotController, bot_names, SCRIPT
+
+LEVELS = ["level1", "level2", "level3"]
+
+# Classes whose attributes a match can override, by name
+TUNABLE = {"Ship": Ship, "Torpedo": Torpedo, "Star": Star,
+           "World": World, "BotController": BotController}
+
+
+class Script(object):
+    """ Holds the same control bits on its ships every step """
+    def __init__(self, indices, controls = SCRIPT):
+        self.indices = list(indices)
+        self.controls = controls
+
+    def steer(self, world):
+        for index in self.indices:
+            if index < len(world.ships):
+                world.ships[index].controls = self.controls
+
+
+class Referee(Quiet):
+    """ Notes how a match ended instead of printing its events """
+    def __init__(self):
+        Quiet.__init__(self)
+        self.world = None
+        self.result = None
+        self.scores = None
+
+    def event(self, kind, text, **fields):
+        if kind in ("win", "out") and self.result is None:
+            self.result = (kind, fields["ship"])
+            # Before the next level replaces the ships
+            self.scores = dict((ship.name, ship.score) for ship in self.world.ships)
+
+
+def tunable(name):
+    """ The class and attribute a "Class.attribute" name refers to """
+    try:
+        (class_name, attribute) = name.split(".", 1)
+    except ValueError:
+        raise ValueError("expected Class.attribute, not %s" % name)
+    if class_name not in TUNABLE:
+        raise ValueError("can't tune %s, only %s" %
+                         (class_name, ", ".join(sorted(TUNABLE))))
+    if not hasattr(TUNABLE[class_name], attribute):
+        raise ValueError("%s has no attribute %s" % (class_name, attribute))
+    return (TUNABLE[class_name], attribute)
+
+
+def override(overrides, saved):
+    """ Set "Class.attribute" values, noting in saved what to restore
+        afterwards as each one is set
+        """
+    for (name, value) in overrides.items():
+        (cls, attribute) = tunable(name)
+        saved.append((cls, attribute, cls.__dict__.get(attribute), attribute in cls.__dict__))
+        setattr(cls, attribute, value)
+
+
+def restore(saved):
+    for (cls, attribute, value, own) in reversed(saved):
+        if own:
+            setattr(cls, attribute, value)
+        else:
+            delattr(cls, attribute)
+
+
+def play(match):
+    """ Play one match to its end and return its result. Runs in a worker """
+    ships = match.get("ships", 2)
+    bots = match.get("bots", ships)
+    referee = Referee()
+    saved = []
+    try:
+        override(match.get("overrides", {}), saved)
+        world = World(tuple(match.get("size", (800, 600))), match["level"],
+                      bot_names(ships), console = referee, seed = match["seed"])
+        referee.world = world
+        controllers = [BotController(range(bots)),
+                       Script(range(bots, ships), match.get("script", SCRIPT))]
+        start = time.perf_counter()
+        while (referee.result is None and world.running and
+               world.ticks < match["max_ticks"]):
+            [controller.steer(world) for controller in controllers]
+            world.step()
+        elapsed = time.perf_counter() - start
+    finally:
+        restore(saved)
+
+    result = dict(match)
+    (result["end"], ship_name) = referee.result or ("draw", None)
+    # A knocked out ship loses; with two ships the other one wins
+    if result["end"] == "win":
+        result["winner"] = ship_name
+    elif result["end"] == "out" and ships == 2:
+        result["winner"] = [ship.name for ship in world.ships
+                            if ship.name != ship_name][0]
+    else:
+        result["winner"] = None
+    result["scores"] = referee.scores or dict((ship.name, ship.score)
+                                              for ship in world.ships)
+    result["ticks"] = world.ticks
+    result["duration"] = world.time / 1000.0
+    result["ticks_per_sec"] = world.ticks / max(elapsed, 1e-9)
+    return result
+
+
+def lay_out(levels, matches, settings, seed, defaults):
+    """ Every combination of the settings values on every level, matches
+        times each, with consecutive seeds (wrapping round)
+        """
+    names = [name for (name, values) in settings]
+    combinations = itertools.product(*[values for (name, values) in settings])
+    plan = []
+    for values in combinations:
+        for level in levels:
+            for i in range(matches):
+                match = dict(defaults)
+                match.update(level = level, seed = (seed + len(plan)) % SEEDS,
+                             overrides = dict(zip(names, values)))
+                plan.append(match)
+    return plan
+
+
+def read_plan(filename, seed, defaults):
+    """ The matches in a plan file, checked before any is played. Raises
+        ValueError naming the first bad line
+        """
+    plan = []
+    with open(filename) as f:
+        for (number, line) in enumerate(f, 1):
+            if not line.strip():
+                continue
+            match = dict(defaults)
+            match["seed"] = (seed + len(plan)) % SEEDS
+            try:
+                match.update(json.loads(line))
+                overrides = match.get("overrides", {})
+                if not isinstance(overrides, dict):
+                    raise ValueError("overrides must be an object")
+                [tunable(name) for name in overrides]
+            except (ValueError, TypeError, AttributeError) as e:
+                raise ValueError("%s line %d: %s" % (filename, number, e))
+            plan.append(match)
+    return plan
+
+
+def setting(text):
+    """ NAME=V1[,V2...] from the command line, values parsed as JSON """
+    try:
+        (name, values) = text.split("=", 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected Class.attribute=value[,value...]")
+    try:
+        tunable(name)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return (name, [json.loads(value) for value in values.split(",")])
+
+
+def ship_count(text):
+    """ A ship count from the command line; a World needs two at least """
+    count = int(text)
+    if count < 2:
+        raise argparse.ArgumentTypeError("a match needs at least 2 ships, not %d" % count)
+    return count
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("levels", nargs = "*", default = LEVELS,
+                        help = "levels to play (default: all shipped levels)")
+    parser.add_argument("--plan", metavar = "FILE",
+                        help = "read the matches from FILE instead, one JSON object a line")
+    parser.add_argument("--matches", type = int, default = 10,
+                        help = "matches for each level and combination of settings")
+    parser.add_argument("--set", dest = "settings", type = setting, action = "append",
+                        default = [], metavar = "CLASS.ATTR=V1[,V2...]",
+                        help = "override a class attribute, trying each value")
+    parser.add_argument("--ships", type = ship_count, default = 2)
+    parser.add_argument("--bots", type = int,
+                        help = "ships flown by bots, the rest are scripted (default: all)")
+    parser.add_argument("--max-ticks", type = int, default = 40000,
+                        help = "steps before a match is called a draw")
+    parser.add_argument("--seed", type = match_seed,
+                        help = "seed of the first match (default: random)")
+    parser.add_argument("--workers", type = int, default = os.cpu_count(),
+                        help = "processes in the pool (default: one per core)")
+    parser.add_argument("--tasks-per-worker", type = int, default = 50,
+                        help = "matches before a worker is replaced")
+    parser.add_argument("-o", "--output", help = "append the results here")
+    options = parser.parse_args(argv)
+
+    seed = options.seed
+    if seed is None:
+        seed = random.getrandbits(31)
+    defaults = {"ships": options.ships, "max_ticks": options.max_ticks}
+    if options.bots is not None:
+        defaults["bots"] = options.bots
+    if options.plan:
+        try:
+            plan = read_plan(options.plan, seed, defaults)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        plan = lay_out(options.levels, options.matches, options.settings,
+                       seed, defaults)
+    for (number, match) in enumerate(plan):
+        match.setdefault("id", number)
+
+    output = open(options.output, "a") if options.output else sys.stdout
+    start = time.perf_counter()
+    pool = multiprocessing.Pool(options.workers,
+                                maxtasksperchild = options.tasks_per_worker)
+    try:
+        for result in pool.imap_unordered(play, plan):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    sys.stderr.write("%d matches in %.1f s\n" % (len(plan), elapsed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
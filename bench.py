@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+""" Headless benchmark for the game loop.
+
+Runs a World on each shipped level under SDL's dummy video driver with
+both ships orbiting and firing continuously, optionally topping up extra
+torpedoes and particles, and reports ticks/second and the time spent in
+each phase of a step as JSON. --ships and --bots soak-test larger matches
+with every ship flown by a BotController.
+
+Drawing only runs its CPU side, with GL calls stubbed out, unless --render
+draws every frame for real into an offscreen framebuffer (see
+lava.offscreen) through Scene.draw_screen(), timing the drawing and the
+wait for GL to finish (the "flip") separately. That works on Mesa's CPU
+rasterizer with no display or GPU; PYOPENGL_PLATFORM has to be egl or
+osmesa, which bench.py sees to when run with --render.
+The last frame of each level can be saved with --capture, or checked
+against the PNGs in a --golden directory (written there the first time).
+
+    python bench.py --ticks 2000 --torpedoes 200 --particles 2000 -o out.json
+    python bench.py --ships 64 --bots level2
+    python bench.py --render --ticks 300 --golden golden
+"""
+import os
+import sys
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+if __name__ == "__main__" and "--render" in sys.argv:
+    # PyOpenGL settles on a platform when OpenGL.GL is first imported, which
+    # happens below. Callers of main() have to set it themselves
+    os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+
+import json
+import math
+import shlex
+import random
+import argparse
+import time
+
+import pygame
+import lava.primitives
+from actors import *
+from world import World
+from bots import BotController, bot_names, SCRIPT
+from lava import offscreen
+
+# After the star import, which brings in OpenGL's own "platform"
+import platform
+
+LEVELS = ["level1", "level2", "level3"]
+
+
+def stub_gl():
+    """ Replace the GL entry points lava.primitives calls with no-ops, so
+        the CPU side of drawing runs without a GL context
+        """
+    def noop(*args, **kwargs):
+        return 0
+
+    for name in dir(lava.primitives):
+        if name.startswith("gl") and callable(getattr(lava.primitives, name)):
+            setattr(lava.primitives, name, noop)
+
+
+def setup_gl(size):
+    """ The GL state spacewar.py sets up, on an ortho projection of size """
+    (width, height) = size
+    glEnable(GL_TEXTURE_2D)
+    glEnable(GL_BLEND)
+    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+    glShadeModel(GL_SMOOTH)
+    glClearColor(0.0, 0.0, 0.0, 0.0)
+    glClearDepth(1.0)
+    glEnable(GL_DEPTH_TEST)
+    glDepthFunc(GL_LEQUAL)
+    glViewport(0, 0, width, height)
+    glMatrixMode(GL_PROJECTION)
+    glLoadIdentity()
+    gluOrtho2D(0.0, float(width), 0.0, float(height))
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+
+
+def top_up_torpedoes(world, torpedoes, count, rng):
+    """ Keep count injected torpedoes flying through random parts of the field """
+    torpedoes[:] = [torpedo for torpedo in torpedoes if torpedo.alive()]
+    (width, height) = world.size
+    while len(torpedoes) < count:
+        torpedo = world.torpedoes.fire(world.ships[len(torpedoes) % len(world.ships)])
+        angle = rng.uniform(0, 2 * math.pi)
+        torpedo.x = rng.uniform(0, width)
+        torpedo.y = rng.uniform(0, height)
+        (torpedo.vx, torpedo.vy) = sincos(angle, 0.3)
+        world.remember(torpedo)
+        torpedoes.append(torpedo)
+
+
+def top_up_particles(world, count, rng):
+    particles = world.particles
+    missing = count - particles.count
+    if missing > 0:
+        (width, height) = world.size
+        particles.emit(rng.uniform(0, width), rng.uniform(0, height),
+                       rng.uniform(0, 360), missing)
+
+
+class WorldView(Scene):
+    """ A Scene drawing a World the way Game does, with the level's
+        background and the ships' names and scores. Its draw and flip
+        phases are marked in the World's profiler
+        """
+    def __init__(self, world, target):
+        Scene.__init__(self, world.size)
+        (width, height) = world.size
+        self.world = world
+        self.target = target
+        self.profiler = world.profiler
+        self.g_render = world.g_render
+        self.g_background.add(Background(world.size, world.level.background))
+        self.scores = [GLText(ship.score, x, height - 55, size=50)
+                       for (ship, x) in zip(world.ships, (20, width - 20))]
+        self.g_hud.add(*self.scores)
+        self.g_hud.add(*[GLText(ship.name, x, height - 20, halign=halign)
+                         for (ship, x, halign) in zip(world.ships, (20, width - 20),
+                                                      ('left', 'right'))])
+
+    def draw_screen(self, alpha = 1.0):
+        for (text, ship) in zip(self.scores, self.world.ships):
+            text.update_string(ship.score)
+        Scene.draw_screen(self, alpha)
+
+
+def check_golden(frame, level, options):
+    """ Compare frame with the level's golden image, or make it the golden
+        image if there isn't one yet
+        """
+    filename = os.path.join(options.golden, level + ".png")
+    if not os.path.exists(filename):
+        offscreen.save_png(frame, filename)
+        return {"written": filename}
+    (largest, differing) = offscreen.difference(frame, offscreen.load_png(filename))
+    return {"largest_difference": largest, "differing_pixels": differing,
+            "match": differing <= options.tolerance}
+
+
+def run_level(level, options, target = None):
+    rng = random.Random(options.seed)
+    random.seed(options.seed)
+    world = World(options.size, level, bot_names(options.ships),
+                  console = Quiet())
+    world.collision_interval = options.collision_interval
+    bots = BotController(range(options.ships))
+    torpedoes = []
+    phases = dict((name, 0.0) for (name, phase) in world.phases)
+    phases["bots"] = 0.0
+    phases["draw"] = 0.0
+    view = None
+    if target is not None:
+        view = WorldView(world, target)
+        phases["flip"] = 0.0
+    # World.step() marks each of its phases
+    profiler = world.profiler
+    profiler.enabled = True
+    clock = time.perf_counter
+
+    start = clock()
+    for tick in range(options.ticks):
+        # Stay on this level when a match ends
+        if world.level_file != level or not world.running:
+            world.running = True
+            world.load_level(level)
+            torpedoes = []
+        profiler.begin()
+        if options.bots:
+            bots.steer(world)
+            profiler.mark("bots")
+        else:
+            for ship in world.ships:
+                ship.controls = SCRIPT
+        top_up_torpedoes(world, torpedoes, options.torpedoes, rng)
+        top_up_particles(world, options.particles, rng)
+        profiler.mark("setup")
+
+        world.step()
+
+        if view is None:
+            world.g_render.draw(0.5)
+            profiler.mark("draw")
+        else:
+            view.draw_screen(0.5)
+    elapsed = clock() - start
+    for (name, seconds) in profiler.totals().items():
+        if name != "setup":
+            phases[name] = seconds
+
+    result = {
+        "level": level,
+        "ticks": options.ticks,
+        "seconds": elapsed,
+        "ticks_per_second": options.ticks / elapsed,
+        "phase_ms_per_tick": dict((name, phases[name] * 1000.0 / options.ticks)
+                                  for name in phases),
+        "phase_seconds": phases,
+        "live_sprites": len(world.g_render),
+        "live_ships": len(world.g_ships),
+        "live_particles": world.particles.count,
+    }
+    if target is not None:
+        frame = target.read()
+        if options.capture:
+            offscreen.save_png(frame, os.path.join(options.capture, level + ".png"))
+        if options.golden:
+            result["golden"] = check_golden(frame, level, options)
+    return result
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("levels", nargs = "*", default = LEVELS,
+                        help = "levels to run (default: all shipped levels)")
+    parser.add_argument("--ticks", type = int, default = 2000,
+                        help = "simulation steps per level")
+    parser.add_argument("--torpedoes", type = int, default = 0,
+                        help = "extra torpedoes to keep in flight")
+    parser.add_argument("--particles", type = int, default = 0,
+                        help = "particles to keep alive")
+    parser.add_argument("--ships", type = int, default = 2,
+                        help = "ships in the match")
+    parser.add_argument("--bots", action = "store_true",
+                        help = "fly the ships with bots instead of orbiting")
+    parser.add_argument("--collision-interval", type = int, default = 1,
+                        help = "steps between collision passes")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--size", type = int, nargs = 2, default = (800, 600),
+                        metavar = ("WIDTH", "HEIGHT"))
+    parser.add_argument("--render", action = "store_true",
+                        help = "draw with real GL into an offscreen framebuffer")
+    parser.add_argument("--capture", metavar = "DIR",
+                        help = "with --render, save each level's last frame as a PNG")
+    parser.add_argument("--golden", metavar = "DIR",
+                        help = "with --render, compare each level's last frame "
+                               "with DIR/<level>.png")
+    parser.add_argument("--tolerance", type = float, default = 0.0,
+                        help = "fraction of pixels that may differ from the golden image")
+    parser.add_argument("--encode", metavar = "COMMAND",
+                        help = "with --render, pipe every frame to COMMAND, "
+                               "given {width} and {height}")
+    parser.add_argument("-o", "--output", help = "write the JSON report here")
+    options = parser.parse_args(argv)
+    options.size = tuple(options.size)
+    if (options.capture or options.golden or options.encode) and not options.render:
+        parser.error("--capture, --golden and --encode need --render")
+
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    target = encoder = None
+    if options.render:
+        try:
+            context = offscreen.create_context(options.size)
+        except RuntimeError as error:
+            parser.error(str(error))
+        target = offscreen.FramebufferTarget(options.size)
+        # Only read frames back when something takes them
+        target.capture = bool(options.encode)
+        if options.encode:
+            encoder = offscreen.EncoderPipe(shlex.split(options.encode), options.size)
+            target.sinks.append(encoder)
+        for directory in (options.capture, options.golden):
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+        setup_gl(options.size)
+    else:
+        stub_gl()
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {"ticks": options.ticks, "torpedoes": options.torpedoes,
+                    "particles": options.particles, "seed": options.seed,
+                    "ships": options.ships, "bots": options.bots,
+                    "collision_interval": options.collision_interval,
+                    "size": options.size, "render": options.render},
+        "results": [run_level(level, options, target) for level in options.levels],
+    }
+    if options.render:
+        report["renderer"] = glGetString(GL_RENDERER).decode()
+        if encoder is not None:
+            encoder.close()
+        target.close()
+        context.close()
+
+    text = json.dumps(report, indent = 2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if [result for result in report["results"]
+        if not result.get("golden", {}).get("match", True)]:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+""" Computer-controlled ships.
+
+A controller is anything with a steer(world) method that sets the control
+bits of the ships it drives, exactly like the keyboard does for human
+players, so bots go through the same thrust, rotate and fire actions and
+are recorded in replays like anyone else. It runs once per step, before
+World.step().
+
+BotController steers all of its ships in one NumPy pass: each bot picks
+the nearest living enemy across the wrapped playfield, leads its shot by
+the torpedo's flight time, and turns away and burns out when a star's
+pull gets too strong.
+"""
+import numpy
+from actors import THRUST, REVERSE, LEFT, RIGHT, FIRE, Torpedo
+
+
+# What scripted ships do instead: orbit and fire; firing also respawns a
+# dead ship
+SCRIPT = THRUST | LEFT | FIRE
+
+
+class BotController(object):
+    # Degrees off the aim point that still count as on target
+    fire_cone = 6.0
+    turn_deadband = 3.0
+    # Keep closing in beyond this distance, back off inside the near one
+    chase_distance = 220.0
+    near_distance = 90.0
+    # Distance from a star's surface where avoidance starts
+    avoid_distance = 140.0
+
+    def __init__(self, indices):
+        """ indices are the positions in world.ships this controller
+            drives, so it carries over to the new ships of each level
+            """
+        self.indices = numpy.asarray(indices, dtype=numpy.intp)
+
+    def steer(self, world):
+        ships = world.ships
+        bots = self.indices[self.indices < len(ships)]
+        if not len(bots):
+            return
+
+        state = numpy.array([(ship.x, ship.y, ship.vx, ship.vy, ship.facing,
+                              ship.alive()) for ship in ships])
+        position = state[:, 0:2]
+        velocity = state[:, 2:4]
+        facing = state[bots, 4]
+        alive = state[:, 5] > 0
+        size = numpy.array(world.size, dtype=float)
+
+        # (bots, ships) wrapped offsets from each bot to every ship
+        offset = wrap(position[None, :, :] - position[bots, None, :], size)
+        distance = numpy.hypot(offset[..., 0], offset[..., 1])
+        candidates = numpy.where(alive[None, :], distance, numpy.inf)
+        candidates[numpy.arange(len(bots)), bots] = numpy.inf
+        target = candidates.argmin(axis=1)
+        has_target = numpy.isfinite(candidates.min(axis=1))
+
+        rows = numpy.arange(len(bots))
+        aim = offset[rows, target]
+        reach = distance[rows, target]
+        aim = aim + self.lead(aim, velocity[target] - velocity[bots])
+
+        # Away from each star, stronger the closer it is
+        away = numpy.zeros_like(aim)
+        danger = numpy.zeros(len(bots))
+        stars = list(world.g_stars)
+        if stars:
+            wells = numpy.array([(star.x, star.y, star.scaled_radius)
+                                 for star in stars])
+            to_star = wrap(wells[None, :, 0:2] - position[bots, None, :], size)
+            length = numpy.maximum(numpy.hypot(to_star[..., 0], to_star[..., 1]), 1e-9)
+            weight = numpy.clip(1.0 - (length - wells[None, :, 2]) / self.avoid_distance,
+                                0.0, 1.0)
+            away = -(to_star / length[..., None] * weight[..., None]).sum(axis=1)
+            danger = weight.max(axis=1)
+
+        aim_length = numpy.maximum(numpy.hypot(aim[:, 0], aim[:, 1]), 1e-9)
+        heading = (aim / aim_length[:, None]) * (1.0 - danger[:, None]) + away * 2.0
+        desired = numpy.degrees(numpy.arctan2(heading[:, 1], heading[:, 0])) - 90.0
+        turn = (desired - facing + 180.0) % 360.0 - 180.0
+        aim_error = (numpy.degrees(numpy.arctan2(aim[:, 1], aim[:, 0])) - 90.0
+                     - facing + 180.0) % 360.0 - 180.0
+
+        controls = numpy.zeros(len(bots), dtype=numpy.int64)
+        controls |= numpy.where(turn > self.turn_deadband, LEFT, 0)
+        controls |= numpy.where(turn < -self.turn_deadband, RIGHT, 0)
+        facing_ahead = numpy.abs(turn) < 45.0
+        controls |= numpy.where(facing_ahead & ((danger > 0.5) |
+                                                (reach > self.chase_distance)),
+                                THRUST, 0)
+        controls |= numpy.where((danger <= 0.5) & (reach < self.near_distance),
+                                REVERSE, 0)
+        # Torpedo's tuning is read as it stands, it may have been changed
+        in_range = reach < Torpedo.speed * Torpedo.lifetime
+        controls |= numpy.where(has_target & in_range &
+                                (numpy.abs(aim_error) < self.fire_cone), FIRE, 0)
+        # Fire also respawns a dead ship
+        controls |= numpy.where(alive[bots], 0, FIRE)
+
+        for index, bits in zip(bots.tolist(), controls.tolist()):
+            ships[index].controls = bits
+
+    def lead(self, offset, velocity):
+        """ Where a target at offset moving at relative velocity will be
+            when a torpedo reaches it, as a correction to offset
+            """
+        # |offset + velocity * t| = speed * t, for the smallest t > 0
+        speed = Torpedo.speed
+        a = (velocity * velocity).sum(axis=1) - speed * speed
+        b = 2.0 * (offset * velocity).sum(axis=1)
+        c = (offset * offset).sum(axis=1)
+        discriminant = b * b - 4.0 * a * c
+        root = numpy.sqrt(numpy.maximum(discriminant, 0.0))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t1 = (-b - root) / (2.0 * a)
+            t2 = (-b + root) / (2.0 * a)
+        t = numpy.where(t1 > 0, t1, t2)
+        t = numpy.where((discriminant >= 0) & numpy.isfinite(t) & (t > 0)
+                        & (t < Torpedo.lifetime), t, 0.0)
+        return velocity * t[:, None]
+
+
+def wrap(offset, size):
+    """ offset folded onto the shortest way across a wrapping playfield """
+    return (offset + size / 2) % size - size / 2
+
+
+def bot_names(count, first = 1):
+    return ["Bot %d" % number for number in range(first, first + count)]
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+""" Generate a level with a large field of static bodies.
+
+Scatters asteroids, which only block, and small gravity wells across the
+playfield, keeps the area around each spawn point clear, then writes the
+level as JSON and compiles it with its spatial index for quick loading.
+
+    python fieldgen.py asteroids --asteroids 3000 --wells 20 --seed 4
+    python spacewar.py asteroids
+"""
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import sys
+import json
+import math
+import random
+import argparse
+from actors import Star
+from lava.levels import compile_level
+
+# Four corners, as in the shipped levels
+SPAWN_POINTS = {
+    "point1": {"facing": 270, "pos_x": 0, "pos_y": -50},
+    "point2": {"facing": 90, "pos_x": -1, "pos_y": -50},
+    "point3": {"facing": 270, "pos_x": 0, "pos_y": 50},
+    "point4": {"facing": 90, "pos_x": -1, "pos_y": 50},
+}
+
+
+def spawn_positions(size):
+    """ Where the spawn points put ships, see SpawnPoint """
+    (width, height) = size
+    positions = []
+    for point in SPAWN_POINTS.values():
+        x = point["pos_x"] % width
+        y = point["pos_y"] % height
+        positions.append((x, y))
+    return positions
+
+
+def scatter(count, radii, gravity, size, keep_clear, rng):
+    """ count bodies of radius within radii, at least keep_clear from
+        every (x, y, distance) in keep_clear. Returns [x, y, radius, gravity]
+        rows
+        """
+    (width, height) = size
+    bodies = []
+    while len(bodies) < count:
+        (x, y) = (rng.uniform(0, width), rng.uniform(0, height))
+        radius = rng.uniform(*radii)
+        clear = True
+        for (cx, cy, distance) in keep_clear:
+            dx = min(abs(x - cx), width - abs(x - cx))
+            dy = min(abs(y - cy), height - abs(y - cy))
+            if math.hypot(dx, dy) < distance + radius:
+                clear = False
+                break
+        if clear:
+            # Pull in proportion to size, as strong as a Star at its radius
+            pull = gravity * radius / 19 if gravity else 0.0
+            bodies.append([round(x, 2), round(y, 2), round(radius, 2), pull])
+    return bodies
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("name", help = "level to write into levels/")
+    parser.add_argument("--asteroids", type = int, default = 2000)
+    parser.add_argument("--wells", type = int, default = 12)
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--size", type = int, nargs = 2, default = (800, 600),
+                        metavar = ("WIDTH", "HEIGHT"))
+    parser.add_argument("--cell-size", type = int, default = 32,
+                        help = "side of the index's cells in pixels")
+    parser.add_argument("--cutoff", type = float, default = 120,
+                        help = "distance from a well's surface where its pull ends")
+    parser.add_argument("--background", default = "images/bkg2.jpg")
+    options = parser.parse_args(argv)
+    size = tuple(options.size)
+
+    rng = random.Random(options.seed)
+    keep_clear = [(x, y, 100.0) for (x, y) in spawn_positions(size)]
+    wells = scatter(options.wells, (8, 14), Star.gravity, size, keep_clear, rng)
+    # Asteroids stay off the wells too
+    keep_clear += [(x, y, radius + 10) for (x, y, radius, pull) in wells]
+    asteroids = scatter(options.asteroids, (2, 5), 0.0, size, keep_clear, rng)
+
+    level = {
+        "name": options.name,
+        "background": options.background,
+        "max_players": 4,
+        "next_level": options.name,
+        "spawn_points": SPAWN_POINTS,
+        "static_entities": {},
+        "static_bodies": {
+            "size": list(size),
+            "cell_size": options.cell_size,
+            "cutoff": options.cutoff,
+            "bodies": wells + asteroids,
+        },
+    }
+    filename = os.path.join("levels", options.name + ".lvl")
+    with open(filename, "w") as f:
+        json.dump(level, f)
+    print("Wrote %s with %d bodies" % (filename, len(wells) + len(asteroids)))
+    print("Compiled %s" % compile_level(filename))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
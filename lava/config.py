@@ -19,6 +19,11 @@ class ConfigManager(object):
         self.player1_name = data['Player1Name']
         self.player2_name = data['Player2Name']
 
+        # frame pacing, 0 fps for as fast as possible
+        self.target_fps = data.get('TargetFPS', 0)
+        self.vsync = data.get('VSync', False)
+        self.render_on_step = data.get('RenderOnStep', False)
+
 
         # Key Bindings
         self.keys = {}
@@ -0,0 +1,75 @@
+import json
+import time
+import queue
+import threading
+import collections
+
+
+class EventLog(object):
+    """ Typed game events, kept off the simulation's critical path.
+
+        event() only appends to memory: the event goes on a bounded queue
+        that a background thread writes to filename as JSON lines, and its
+        text onto the last few lines shown on screen. If the writer falls
+        behind and the queue fills up, new events are counted in dropped
+        rather than making the game wait.
+
+        Without a filename every event's text is printed instead, as a
+        plain Console does. Has the same write() as Console, so it can
+        stand in for one.
+        """
+    # Kinds that are printed or go to the file but would only crowd the screen
+    hidden = ("fps",)
+
+    def __init__(self, filename = None, capacity = 4096, lines = 6):
+        self.filename = filename
+        self.lines = collections.deque(maxlen=lines)
+        # Bumped with every new line, so views know when to redraw
+        self.version = 0
+        self.dropped = 0
+        self.queue = queue.Queue(capacity)
+        self.writer = None
+        if filename:
+            self.writer = threading.Thread(target=self.flush_events,
+                                           name="event-log", daemon=True)
+            self.writer.start()
+
+    def write(self, text):
+        self.event("message", text)
+
+    def event(self, kind, text, **fields):
+        if kind not in self.hidden:
+            self.lines.append(text)
+            self.version += 1
+        if self.writer is None:
+            print(text)
+            return
+        record = {"time": time.time(), "kind": kind, "text": text}
+        record.update(fields)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush_events(self):
+        with open(self.filename, 'a') as f:
+            while True:
+                record = self.queue.get()
+                # Write whatever else is waiting before flushing
+                while record is not None:
+                    f.write(json.dumps(record) + "\n")
+                    try:
+                        record = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                f.flush()
+                if record is None:
+                    return
+
+    def close(self):
+        """ Write out the queued events and stop the writer """
+        if self.writer is None:
+            return
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
@@ -1,23 +1,82 @@
 ﻿import json
 import os
 import os.path
+import threading
+import collections
+import numpy
+from lava.physics import StaticBodies
 
 class LevelManager(object):
     def __init__(self, filepath = "levels"):
         self.filepath = filepath
+        self.cache = {}
     
     def load(self, filename):
+        try:
+            return self.cache.pop(filename)
+        except KeyError:
+            return self.read(filename)
+
+    def prefetch(self, filename):
+        """ Parse filename now so the next load() of it is free """
+        self.cache[filename] = self.read(filename)
+        return self.cache[filename]
+
+    def read(self, filename):
         fqpn = os.path.join(self.filepath, filename)
 
         if not os.path.exists(fqpn):
             fqpn = os.path.join(self.filepath, filename + ".lvl")
 
+        # Use the compiled level unless the source is newer
+        compiled = os.path.splitext(fqpn)[0] + ".lvlc"
+        if os.path.exists(compiled) and (not os.path.exists(fqpn) or
+                os.path.getmtime(compiled) >= os.path.getmtime(fqpn)):
+            return read_compiled(compiled, fqpn)
+
         with open(fqpn, 'r') as f:
             level_data = json.load(f)
 
         return Level(level_data, fqpn)
 
 
+class LevelPrefetcher(object):
+    """ Parses a level and maps its cached textures on a worker thread.
+
+        images(level) lists the (file, directory) pairs a level needs.
+        Images whose mipmaps are ready (built into the texture cache first if
+        need be) are queued on ready for the main thread, which only has to
+        upload them.
+        """
+    def __init__(self, levels, media, images):
+        self.levels = levels
+        self.media = media
+        self.images = images
+        self.requested = set()
+        self.ready = collections.deque()
+
+    def request(self, filename):
+        if not filename or filename in self.requested:
+            return
+        self.requested.add(filename)
+        worker = threading.Thread(target=self.fetch, args=(filename,))
+        worker.daemon = True
+        worker.start()
+
+    def fetch(self, filename):
+        try:
+            level = self.levels.prefetch(filename)
+            for (file, directory) in self.images(level):
+                self.media.load_mipmaps(file, directory)
+                self.ready.append((file, directory))
+        except Exception:
+            # The main thread reports it properly when it loads the level
+            pass
+        finally:
+            # Levels that come round again are fetched again
+            self.requested.discard(filename)
+
+
 class Level(object):
     def __init__(self, level_data = None, level_file = None):
         self.file = level_file
@@ -35,13 +94,83 @@ class Level(object):
             self.static_entities = {}
             self.spawn_points = {}
             self.next_level = None
+        # Optional, see compile_level()
+        self.static_bodies = (level_data or {}).get('static_bodies')
 
     def __repr__(self):
         return str({"name": self.name, "background": self.background, "static_entities": self.static_entities, "spawn_points": self.spawn_points})
 
 
+def body_indices(static_bodies, size):
+    """ StaticBodies for all of a level's static bodies and for the ones
+        that pull, reusing the index stored with the level if it was
+        built for this size of playfield
+        """
+    bodies = numpy.asarray(static_bodies['bodies'], dtype=numpy.float64).reshape(-1, 4)
+    cell_size = static_bodies.get('cell_size', 64)
+    index = static_bodies.get('index', {})
+    if tuple(static_bodies.get('size', size)) != tuple(size):
+        index = {}
+    return (StaticBodies(size, bodies, cell_size, index.get('bodies')),
+            StaticBodies(size, bodies[bodies[:, 3] > 0], cell_size, index.get('wells')))
+
+
+def compile_level(filename, destination = None):
+    """ Write a level with its static bodies as arrays and their index
+        prebuilt, next to filename unless destination is given.
+
+        Static bodies are listed in a level as
+
+            "static_bodies": {"size": [800, 600], "cell_size": 32,
+                              "cutoff": 120, "bodies": [[x, y, radius, gravity], ...]}
+
+        which is slow to parse and index once there are thousands of
+        them, so LevelManager prefers the compiled file when it is newer.
+        """
+    with open(filename, 'r') as f:
+        level_data = json.load(f)
+    static_bodies = level_data.pop('static_bodies', None) or {'bodies': []}
+    size = tuple(static_bodies.get('size', (800, 600)))
+    (bodies, wells) = body_indices(static_bodies, size)
+
+    if destination is None:
+        destination = os.path.splitext(filename)[0] + ".lvlc"
+    options = dict((key, value) for (key, value) in static_bodies.items()
+                   if key != 'bodies')
+    options['size'] = size
+    with open(destination + ".tmp", 'wb') as f:
+        numpy.savez(f, level=numpy.frombuffer(json.dumps(level_data).encode("utf-8"),
+                                              dtype=numpy.uint8),
+                    options=numpy.frombuffer(json.dumps(options).encode("utf-8"),
+                                             dtype=numpy.uint8),
+                    bodies=bodies.bodies,
+                    body_start=bodies.start, body_items=bodies.items,
+                    well_start=wells.start, well_items=wells.items)
+    os.replace(destination + ".tmp", destination)
+    return destination
+
+
+def read_compiled(filename, source = None):
+    """ The Level written by compile_level() """
+    with numpy.load(filename, allow_pickle=False) as data:
+        level_data = json.loads(data['level'].tobytes().decode("utf-8"))
+        static_bodies = json.loads(data['options'].tobytes().decode("utf-8"))
+        static_bodies['bodies'] = data['bodies']
+        static_bodies['index'] = {'bodies': (data['body_start'], data['body_items']),
+                                  'wells': (data['well_start'], data['well_items'])}
+    if len(static_bodies['bodies']):
+        level_data['static_bodies'] = static_bodies
+    return Level(level_data, source or filename)
+
+
 if __name__ == "__main__":
-    print("Loading level data from ./level1.lvl")
-    lm = LevelManager(".")
-    level = lm.load("level1.lvl")
-    print(str(level))
+    import sys
+    if sys.argv[1:]:
+        # python -m lava.levels levels/field.lvl ...
+        for filename in sys.argv[1:]:
+            print("Compiled %s" % compile_level(filename))
+    else:
+        print("Loading level data from ./level1.lvl")
+        lm = LevelManager(".")
+        level = lm.load("level1.lvl")
+        print(str(level))
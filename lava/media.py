@@ -1,10 +1,184 @@
+import os
+import mmap
+import struct
+import hashlib
+import tempfile
 from os import path
-from pygame import image
+import numpy
+from pygame import image, surfarray
+
+
+class TextureCache(object):
+    """ Pre-converted textures on disk, next to their source images.
+
+        Each image is stored once as raw RGBA with its whole mipmap chain in
+        a .texcache/<name>.<source hash>.tex file. Loading memory-maps that
+        file and hands out zero-copy views of each level, so a warm start
+        does no decoding, conversion or mipmap generation. A file that is
+        stale, truncated or unreadable is rebuilt.
+        """
+    MAGIC = b"LTEX"
+    VERSION = 2
+    # magic, version, sha1 of the source image, mipmap levels
+    HEADER = struct.Struct("<4sH20sH")
+    # width, height, offset of the level's data
+    LEVEL = struct.Struct("<III")
+
+    def __init__(self, directory = '.texcache'):
+        self.directory = directory
+        self.mapped = {}
+
+    def path(self, source, digest):
+        (folder, name) = path.split(source)
+        return path.join(folder, self.directory,
+                         "%s.%s.tex" % (name, digest.hex()[:16]))
+
+    def load(self, source, decode):
+        """ [(width, height, data), ...] from the full size level down to
+            1x1 for the image at source. decode() gives the image's
+            (width, height, RGBA data) if the cache has to be built.
+            """
+        with open(source, 'rb') as f:
+            digest = hashlib.sha1(f.read()).digest()
+        cached = self.path(source, digest)
+        try:
+            return self.map(cached, digest)
+        except (OSError, ValueError):
+            pass
+
+        levels = mipmaps(*decode())
+        try:
+            self.write(cached, digest, levels)
+            return self.map(cached, digest)
+        except OSError:
+            # Read-only tree, go on without the cache
+            return levels
+
+    def map(self, cached, digest):
+        with open(cached, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, source_digest, count) = self.HEADER.unpack_from(mapping, 0)
+            if magic != self.MAGIC or version != self.VERSION or source_digest != digest:
+                raise ValueError("stale texture cache %s" % cached)
+            table = [self.LEVEL.unpack_from(mapping, self.HEADER.size + self.LEVEL.size * i)
+                     for i in range(count)]
+        except (struct.error, ValueError):
+            mapping.close()
+            raise ValueError("stale or truncated texture cache %s" % cached)
+        # Check every level fits before handing out views of the mapping
+        if any(start + width * height * 4 > len(mapping)
+               for (width, height, start) in table):
+            mapping.close()
+            raise ValueError("truncated texture cache %s" % cached)
+
+        levels = [(width, height,
+                   numpy.frombuffer(mapping, numpy.uint8, width * height * 4, start))
+                  for (width, height, start) in table]
+        self.mapped[cached] = mapping
+        return levels
+
+    def write(self, cached, digest, levels):
+        folder = path.dirname(cached)
+        if not path.isdir(folder):
+            os.makedirs(folder)
+        # Drop the files built from older versions of the same image
+        prefix = path.basename(cached).rsplit('.', 2)[0] + '.'
+        for name in os.listdir(folder):
+            if name.startswith(prefix) and name.endswith('.tex'):
+                os.remove(path.join(folder, name))
+
+        offset = self.HEADER.size + self.LEVEL.size * len(levels)
+        table = []
+        for (width, height, data) in levels:
+            # Start each level on a 16 byte boundary
+            offset += -offset % 16
+            table.append(offset)
+            offset += width * height * 4
+
+        # A file of its own, so processes building the same cache at once
+        # never write into each other's
+        (handle, temporary) = tempfile.mkstemp('.tmp', '', folder)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.VERSION, digest, len(levels)))
+                for (width, height, data), start in zip(levels, table):
+                    f.write(self.LEVEL.pack(width, height, start))
+                for (width, height, data), start in zip(levels, table):
+                    f.write(b'\0' * (start - f.tell()))
+                    f.write(bytes(data))
+            os.replace(temporary, cached)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+
+def power_of_two(value):
+    """ The power of two gluBuild2DMipmaps() scales a side of value to: the
+        one below, or the one above from one and a half times the one below
+        """
+    power = 1
+    while power * 2 <= value:
+        power *= 2
+    if power > 1 and value >= power + power // 2:
+        power *= 2
+    return power
+
+
+def scale(width, height, data, new_width, new_height):
+    """ RGBA data resized to new_width x new_height, filtered bilinearly """
+    pixels = numpy.frombuffer(data, numpy.uint8).reshape(height, width, 4).astype(numpy.float32)
+    for (axis, old, new) in ((0, height, new_height), (1, width, new_width)):
+        if old == new:
+            continue
+        # Where the centre of each new pixel falls among the old ones
+        position = numpy.clip((numpy.arange(new) + 0.5) * old / new - 0.5, 0, old - 1)
+        low = position.astype(numpy.intp)
+        high = numpy.minimum(low + 1, old - 1)
+        weight = (position - low).reshape((-1, 1, 1) if axis == 0 else (1, -1, 1))
+        pixels = (numpy.take(pixels, low, axis) * (1 - weight) +
+                  numpy.take(pixels, high, axis) * weight)
+    return numpy.round(pixels).astype(numpy.uint8).reshape(-1)
+
+
+def mipmaps(width, height, data):
+    """ The full mipmap chain of RGBA data, each level a 2x2 box filter of
+        the one before, halving each side (rounding down) until 1x1.
+
+        Sides that aren't powers of two are scaled to one first, as
+        gluBuild2DMipmaps() did, since GL before 2.0 can't use the texture
+        otherwise.
+        """
+    (new_width, new_height) = (power_of_two(width), power_of_two(height))
+    if (new_width, new_height) != (width, height):
+        data = scale(width, height, data, new_width, new_height)
+        (width, height) = (new_width, new_height)
+    level = numpy.frombuffer(data, numpy.uint8).reshape(height, width, 4)
+    levels = [(width, height, level.reshape(-1))]
+    while width > 1 or height > 1:
+        height = max(1, height // 2)
+        width = max(1, width // 2)
+        pixels = level.astype(numpy.uint32)
+        if pixels.shape[0] > 1:
+            pixels = pixels[0:height * 2:2] + pixels[1:height * 2:2]
+        else:
+            pixels = pixels * 2
+        if pixels.shape[1] > 1:
+            pixels = pixels[:, 0:width * 2:2] + pixels[:, 1:width * 2:2]
+        else:
+            pixels = pixels * 2
+        level = ((pixels + 2) // 4).astype(numpy.uint8)
+        levels.append((width, height, level.reshape(-1)))
+    return levels
+
 
 class MediaManager:
     def __init__(self, basedir = '.'):
         self.basedir = basedir
         self.media = {}
+        self.pixels = {}
+        self.textures = {}
+        self.cache = TextureCache()
     
     def load_image(self, file, directory = ''):
         try:
@@ -22,3 +196,50 @@ class MediaManager:
             image_obj = image.load(fqpn).convert()
             self.media[file] = image_obj
             return image_obj
+
+    def load_pixels(self, file, directory = ''):
+        """ (width, height, data) for file as bottom-up RGBA texture data.
+
+            The color of the top left pixel is transparent and everything
+            else is opaque, as with a converted surface colorkeyed on that
+            pixel. Needs no display, so it is safe to call from a worker
+            thread before the image is wanted.
+            """
+        try:
+            return self.pixels[file]
+        except KeyError:
+            surface = image.load(path.join(self.basedir, directory, file))
+            rgb = surfarray.array3d(surface)
+            alpha = numpy.where((rgb == rgb[0, 0]).all(axis=2), 0, 255)
+            rgba = numpy.dstack((rgb, alpha.astype(numpy.uint8)))
+            # surfarray is indexed [x, y] from the top, GL wants rows from the bottom
+            data = numpy.ascontiguousarray(rgba.transpose(1, 0, 2)[::-1]).tobytes()
+            pixels = self.pixels[file] = (surface.get_width(), surface.get_height(), data)
+            return pixels
+
+    def load_mipmaps(self, file, directory = ''):
+        """ The cached mipmap chain for file, see TextureCache.load() """
+        try:
+            return self.textures[file]
+        except KeyError:
+            source = path.join(self.basedir, directory, file)
+            levels = self.textures[file] = self.cache.load(
+                source, lambda: self.load_pixels(file, directory))
+            # The decoded copy was only needed to build the cache
+            self.pixels.pop(file, None)
+            return levels
+
+
+if __name__ == "__main__":
+    import sys
+    # Build the texture cache for every image in the given directories
+    media = MediaManager()
+    for directory in sys.argv[1:] or ['images']:
+        for file in sorted(os.listdir(directory)):
+            if path.isfile(path.join(directory, file)):
+                try:
+                    levels = media.load_mipmaps(file, directory)
+                except Exception as e:
+                    print("Skipping %s: %s" % (file, e))
+                else:
+                    print("%s: %dx%d, %d levels" % (file, levels[0][0], levels[0][1], len(levels)))
@@ -0,0 +1,223 @@
+""" Rendering without a window, for benchmarks and golden images.
+
+A headless GL context comes from EGL, which Mesa provides even with no
+display server or GPU (its llvmpipe rasterizer runs on the CPU), or from
+OSMesa. PyOpenGL picks its backend when OpenGL.GL is first imported, so
+PYOPENGL_PLATFORM has to be "egl" or "osmesa" by then:
+
+    os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+    ...
+    context = create_context((800, 600))
+    scene.target = FramebufferTarget((800, 600))
+    scene.target.sinks.append(PNGWriter("frames/%05d.png"))
+
+Frames are drawn into a framebuffer object and read back into one numpy
+array that is reused frame after frame; sinks get a view of it, flipped
+to run top to bottom. Like the window, frames are opaque: whatever
+blending leaves in the alpha channel is ignored.
+"""
+import os
+import ctypes
+import subprocess
+import numpy
+import pygame
+from OpenGL.GL import *
+
+
+class EGLContext(object):
+    """ A GL compatibility profile context on a pbuffer, with no window """
+    def __init__(self, size):
+        # Mesa finds no display to talk to on a headless machine otherwise
+        os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+        from OpenGL import EGL
+        self.egl = EGL
+        (width, height) = size
+
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        (major, minor) = (EGL.EGLint(), EGL.EGLint())
+        if not EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError("EGL could not be initialized")
+
+        attributes = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                      EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8,
+                      EGL.EGL_BLUE_SIZE, 8, EGL.EGL_ALPHA_SIZE, 8,
+                      EGL.EGL_DEPTH_SIZE, 24,
+                      EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE]
+        config = EGL.EGLConfig()
+        count = EGL.EGLint()
+        if not (EGL.eglChooseConfig(self.display, (EGL.EGLint * len(attributes))(*attributes),
+                                    ctypes.pointer(config), 1, ctypes.pointer(count))
+                and count.value):
+            raise RuntimeError("no EGL config for desktop GL on a pbuffer")
+
+        surface = [EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE]
+        self.surface = EGL.eglCreatePbufferSurface(self.display, config,
+                                                   (EGL.EGLint * len(surface))(*surface))
+        # The sprites use fixed function GL, not GLES
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, None)
+        if not EGL.eglMakeCurrent(self.display, self.surface, self.surface, self.context):
+            raise RuntimeError("could not make the EGL context current")
+
+    def close(self):
+        EGL = self.egl
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE,
+                           EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroyContext(self.display, self.context)
+        EGL.eglDestroySurface(self.display, self.surface)
+        EGL.eglTerminate(self.display)
+
+
+class OSMesaContext(object):
+    """ A GL context that renders into memory with Mesa's OSMesa """
+    def __init__(self, size):
+        from OpenGL import osmesa
+        self.osmesa = osmesa
+        (width, height) = size
+        self.context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+        if not self.context:
+            raise RuntimeError("OSMesa context could not be created")
+        # Only the framebuffer object is drawn to, but a buffer is required
+        self.buffer = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+        if not osmesa.OSMesaMakeCurrent(self.context, self.buffer, GL_UNSIGNED_BYTE,
+                                        width, height):
+            raise RuntimeError("could not make the OSMesa context current")
+
+    def close(self):
+        self.osmesa.OSMesaDestroyContext(self.context)
+
+
+def create_context(size):
+    """ A headless context on whichever platform PyOpenGL was loaded for """
+    from OpenGL import platform
+    loaded = type(platform.PLATFORM).__name__
+    if loaded == "OSMesaPlatform":
+        return OSMesaContext(size)
+    if loaded == "EGLPlatform":
+        return EGLContext(size)
+    raise RuntimeError("PyOpenGL was loaded for %s, which needs a window; set "
+                       "PYOPENGL_PLATFORM to egl or osmesa before OpenGL.GL is "
+                       "first imported" % loaded)
+
+
+class FramebufferTarget(object):
+    """ A render target for Scene.draw_screen() in place of the window.
+
+        begin() binds a framebuffer object with a colour and a depth
+        renderbuffer, and present() reads the frame back into pixels and
+        hands it to each of sinks. With capture off, present() only waits
+        for GL to finish, which is what a throughput benchmark wants.
+        """
+    def __init__(self, size):
+        (width, height) = size
+        self.size = size
+        self.capture = True
+        self.sinks = []
+        self.frames = 0
+
+        self.framebuffer = glGenFramebuffers(1)
+        (self.color, self.depth) = glGenRenderbuffers(2)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.color)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.depth)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
+                                  GL_RENDERBUFFER, self.color)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT,
+                                  GL_RENDERBUFFER, self.depth)
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("framebuffer incomplete: 0x%x" % status)
+
+        # Read back into the same memory every frame
+        self.pixels = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+
+    def begin(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        glViewport(0, 0, self.size[0], self.size[1])
+
+    def present(self):
+        self.frames += 1
+        if not self.capture:
+            glFinish()
+            return
+        frame = self.read()
+        for sink in self.sinks:
+            sink(frame)
+
+    def read(self):
+        """ The frame as a (height, width, 4) RGBA view, top row first """
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixels(0, 0, self.size[0], self.size[1], GL_RGBA, GL_UNSIGNED_BYTE,
+                     self.pixels)
+        # GL's rows run bottom to top
+        return self.pixels[::-1]
+
+    def close(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glDeleteRenderbuffers(2, [self.color, self.depth])
+        glDeleteFramebuffers(1, [self.framebuffer])
+
+
+def save_png(frame, filename):
+    """ Write a (height, width, 4) RGBA frame as an opaque PNG """
+    (height, width) = frame.shape[:2]
+    image = pygame.image.frombuffer(numpy.ascontiguousarray(frame).tobytes(),
+                                    (width, height), "RGBX")
+    pygame.image.save(image, filename)
+
+
+def load_png(filename):
+    """ A PNG as a (height, width, 4) RGBA array, as save_png() wrote it """
+    image = pygame.image.load(filename)
+    (width, height) = image.get_size()
+    data = pygame.image.tostring(image, "RGBA")
+    return numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width, 4)
+
+
+def difference(frame, golden):
+    """ (largest colour difference, fraction of pixels that differ at
+        all) between two frames, for comparing against a golden image
+        """
+    if frame.shape[:2] != golden.shape[:2]:
+        return (255, 1.0)
+    delta = numpy.abs(frame[..., :3].astype(numpy.int16) -
+                      golden[..., :3].astype(numpy.int16))
+    return (int(delta.max()), float(numpy.count_nonzero(delta.max(axis=2))) / delta[..., 0].size)
+
+
+class PNGWriter(object):
+    """ A sink saving each frame to pattern % frame number """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.frames = 0
+
+    def __call__(self, frame):
+        save_png(frame, self.pattern % self.frames)
+        self.frames += 1
+
+
+class EncoderPipe(object):
+    """ A sink streaming raw RGBA frames to the standard input of command,
+        which is given the frame size, for example
+
+            EncoderPipe(["ffmpeg", "-y", "-f", "rawvideo", "-pix_fmt", "rgb0",
+                         "-s", "{width}x{height}", "-r", "60", "-i", "-",
+                         "match.mp4"], (800, 600))
+        """
+    def __init__(self, command, size):
+        (width, height) = size
+        command = [part.format(width=width, height=height) for part in command]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        # Frames are flipped into here before writing, rather than copied anew
+        self.buffer = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+
+    def __call__(self, frame):
+        numpy.copyto(self.buffer, frame)
+        self.process.stdin.write(memoryview(self.buffer).cast("B"))
+
+    def close(self):
+        self.process.stdin.close()
+        return self.process.wait()
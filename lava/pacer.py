@@ -0,0 +1,81 @@
+import time
+
+
+class FramePacer(object):
+    """ Holds a loop to a steady frame rate without spinning a core.
+
+        wait() blocks until the next frame is due. It sleeps through most
+        of the wait, since sleep() can overshoot by a millisecond or two,
+        and spins through the last spin seconds to hit the deadline
+        closely. A target of 0 fps doesn't pace at all.
+
+        frame() counts a frame as drawn; a loop pass that draws nothing
+        doesn't call it. report() gives the rate of drawn frames, its
+        jitter and the fraction of time spent waiting since the previous
+        report.
+        """
+    # Seconds before a deadline to stop sleeping and start spinning
+    spin = 0.002
+
+    def __init__(self, fps = 0):
+        self.fps = fps
+        self.period = 1.0 / fps if fps else 0.0
+        self.deadline = None
+        self.last = None
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.frames = 0
+        self.idle = 0.0
+        self.total = 0.0
+        self.squares = 0.0
+
+    def wait(self):
+        """ Wait for the next frame, returning the seconds spent idle """
+        now = time.perf_counter()
+        idle = 0.0
+        if self.period:
+            if self.deadline is None or now - self.deadline > self.period:
+                # First frame, or too far behind to catch up: start over
+                self.deadline = now
+            self.deadline += self.period
+            idle = self.wait_until(self.deadline)
+        return idle
+
+    def frame(self):
+        """ Count a frame drawn now """
+        now = time.perf_counter()
+        if self.last is not None:
+            interval = now - self.last
+            self.frames += 1
+            self.total += interval
+            self.squares += interval * interval
+        self.last = now
+
+    def wait_until(self, deadline):
+        """ Sleep, then spin, until deadline on the perf_counter() clock """
+        start = time.perf_counter()
+        remaining = deadline - start
+        if remaining <= 0:
+            return 0.0
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while time.perf_counter() < deadline:
+            pass
+        idle = time.perf_counter() - start
+        self.idle += idle
+        return idle
+
+    def report(self):
+        """ (fps, jitter in ms, idle fraction) since the last report """
+        elapsed = time.perf_counter() - self.started
+        fps = jitter = 0.0
+        if self.frames:
+            mean = self.total / self.frames
+            variance = max(self.squares / self.frames - mean * mean, 0.0)
+            fps = 1.0 / mean if mean else 0.0
+            jitter = variance ** 0.5 * 1000.0
+        idle = self.idle / elapsed if elapsed > 0 else 0.0
+        self.reset()
+        return (fps, jitter, idle)
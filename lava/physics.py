@@ -1,4 +1,5 @@
-﻿import math
+import math
+import numpy
 
 def radial_collide(item1, item2):
     """ item1 and item2 are 3-tuples in the format of
@@ -8,4 +9,376 @@ def radial_collide(item1, item2):
     y_diff = item1[1] - item2[1]
     hit_radius = item1[2] + item2[2]
 
-    return math.hypot(x_diff, y_diff) < hit_radius
\ No newline at end of file
+    return math.hypot(x_diff, y_diff) < hit_radius
+
+def wrapped_collide(item1, item2, size):
+    """ Like radial_collide() for objects with x, y and scaled_radius
+        attributes, measuring distance across the edges of a playfield
+        of size (width, height) that wraps around
+        """
+    (width, height) = size
+    x_diff = abs(item1.x - item2.x) % width
+    y_diff = abs(item1.y - item2.y) % height
+    if x_diff > width / 2:
+        x_diff = width - x_diff
+    if y_diff > height / 2:
+        y_diff = height - y_diff
+    hit_radius = item1.scaled_radius + item2.scaled_radius
+
+    return x_diff * x_diff + y_diff * y_diff < hit_radius * hit_radius
+
+def time_of_impact(item1, item2, size):
+    """ Swept version of wrapped_collide() for objects that also have
+        sweep_dx and sweep_dy, how far they moved in a straight line to
+        reach x and y, and sweep_span, how long that took. Only the motion
+        both made over the shorter span is compared. Returns the fraction
+        of that span (0 to 1) after which the circles first touch, or None
+        if they never do, so objects that passed through each other
+        between checks still hit.
+        """
+    (width, height) = size
+    # Offset from item1 to item2 now, the short way round
+    x_diff = (item2.x - item1.x + width / 2) % width - width / 2
+    y_diff = (item2.y - item1.y + height / 2) % height - height / 2
+    # and item2's motion relative to item1
+    span = min(item1.sweep_span, item2.sweep_span)
+    share1 = span / item1.sweep_span
+    share2 = span / item2.sweep_span
+    x_move = item2.sweep_dx * share2 - item1.sweep_dx * share1
+    y_move = item2.sweep_dy * share2 - item1.sweep_dy * share1
+    x_start = x_diff - x_move
+    y_start = y_diff - y_move
+    hit_radius = item1.scaled_radius + item2.scaled_radius
+
+    # |start + move * t| = hit_radius
+    c = x_start * x_start + y_start * y_start - hit_radius * hit_radius
+    if c <= 0:
+        return 0.0
+    a = x_move * x_move + y_move * y_move
+    b = 2 * (x_start * x_move + y_start * y_move)
+    discriminant = b * b - 4 * a * c
+    if a == 0 or b >= 0 or discriminant < 0:
+        return None
+    t = (-b - math.sqrt(discriminant)) / (2 * a)
+    if t > 1:
+        return None
+    return t
+
+def swept_collide(item1, item2, size):
+    return time_of_impact(item1, item2, size) is not None
+
+def gravitate(wells, bodies, interval):
+    """ Accelerate every body toward every well in one NumPy pass.
+
+        wells have x, y, scaled_radius and gravity (the pull per ms at the
+        well's surface), bodies have x, y, vx and vy. The pull falls off as
+        1 / r ** 2 with r = distance / 200 + 1, measured from the well's
+        surface, and is zero inside it, so a well never pulls on itself.
+        """
+    wells = list(wells)
+    bodies = list(bodies)
+    if not wells or not bodies:
+        return
+
+    sources = numpy.array([(well.x, well.y, well.scaled_radius, well.gravity)
+                           for well in wells])
+    targets = numpy.array([(body.x, body.y) for body in bodies])
+    (ax, ay) = acceleration(sources, targets[:, 0], targets[:, 1])
+    accelerate(bodies, ax * interval, ay * interval)
+
+def acceleration(sources, x, y):
+    """ The pull per ms of the (x, y, radius, gravity) rows of sources at
+        the points x, y, see gravitate()
+        """
+    # (wells, points) vectors from each point to each well
+    dx = sources[:, 0, None] - x
+    dy = sources[:, 1, None] - y
+    length = numpy.hypot(dx, dy)
+    distance = length - sources[:, 2, None]
+
+    r = distance / 200 + 1
+    force = numpy.where(distance > 0, sources[:, 3, None] / (r * r), 0.0)
+    # Scale the vectors to unit length and the force in one step
+    scale = numpy.divide(force, length, out=numpy.zeros_like(force),
+                         where=length > 0)
+
+    return ((dx * scale).sum(axis=0), (dy * scale).sum(axis=0))
+
+def accelerate(bodies, ax, ay):
+    for body, gx, gy in zip(bodies, ax.tolist(), ay.tolist()):
+        body.vx += gx
+        body.vy += gy
+
+
+class GravityField(object):
+    """ The pull of wells that stay put, precomputed over the playfield.
+
+        The acceleration is worked out once on a grid of points spacing
+        pixels apart and bilinearly interpolated at each body, so a step
+        costs the same however many wells there are. The grid is rebuilt
+        whenever a well moves, is rescaled or changes strength. Sampling
+        blurs the edge of a well by up to one grid cell, where bodies are
+        about to hit it anyway.
+        """
+    def __init__(self, size, spacing = 4):
+        (width, height) = size
+        self.size = size
+        self.columns = max(1, int(math.ceil(width / float(spacing))))
+        self.rows = max(1, int(math.ceil(height / float(spacing))))
+        # Stretch the grid to land exactly on the playfield's edges
+        self.cell_width = width / float(self.columns)
+        self.cell_height = height / float(self.rows)
+        self.scale = numpy.array([1 / self.cell_width, 1 / self.cell_height])
+        # Keep the lower corner of every cell inside the grid
+        self.limit = numpy.array([self.columns, self.rows]) - 1e-9
+        self.wells = None
+        # (ax, ay) at every grid point, row by row
+        self.grid = None
+
+    def rebuild(self, sources):
+        x = numpy.linspace(0, self.size[0], self.columns + 1)
+        y = numpy.linspace(0, self.size[1], self.rows + 1)
+        (x, y) = numpy.meshgrid(x, y)
+        self.grid = numpy.column_stack(acceleration(sources, x.ravel(), y.ravel()))
+
+    def sample(self, points):
+        """ Interpolated (points, 2) array of (ax, ay) at the (points, 2)
+            array of x, y
+            """
+        cell = points * self.scale
+        numpy.maximum(cell, 0, out=cell)
+        numpy.minimum(cell, self.limit, out=cell)
+        corner = cell.astype(numpy.intp)
+        cell -= corner
+        (fu, fv) = (cell[:, 0:1], cell[:, 1:2])
+
+        grid = self.grid
+        below = corner[:, 1] * (self.columns + 1) + corner[:, 0]
+        above = below + self.columns + 1
+        bottom = grid.take(below, axis=0)
+        bottom += (grid.take(below + 1, axis=0) - bottom) * fu
+        top = grid.take(above, axis=0)
+        top += (grid.take(above + 1, axis=0) - top) * fu
+        bottom += (top - bottom) * fv
+        return bottom
+
+    def gravitate(self, wells, bodies, interval):
+        """ gravitate() for wells that don't move """
+        wells = list(wells)
+        bodies = list(bodies)
+        if not wells or not bodies:
+            return
+
+        key = [(well.x, well.y, well.scaled_radius, well.gravity)
+               for well in wells]
+        if key != self.wells:
+            self.wells = key
+            self.rebuild(numpy.array(key))
+
+        targets = numpy.array([(body.x, body.y) for body in bodies])
+        pull = self.sample(targets) * interval
+        accelerate(bodies, pull[:, 0], pull[:, 1])
+
+
+class SpatialHash(object):
+    """ Uniform grid broadphase over a playfield that wraps at its edges.
+
+        Items are anything with x, y and scaled_radius attributes. The grid
+        is rebuilt once per collision pass, and query() returns the items in
+        the cells an item can reach, so objects on opposite edges of the
+        playfield are still found as neighbours.
+        """
+    def __init__(self, size, cell_size = 64):
+        (width, height) = size
+        self.size = size
+        self.columns = max(1, int(math.ceil(width / float(cell_size))))
+        self.rows = max(1, int(math.ceil(height / float(cell_size))))
+        # Stretch the cells so the grid tiles the playfield exactly
+        self.cell_width = width / float(self.columns)
+        self.cell_height = height / float(self.rows)
+        self.cells = {}
+        self.max_radius = 0.0
+        self.padding = 0.0
+
+    def cell(self, x, y):
+        return (int(x // self.cell_width) % self.columns,
+                int(y // self.cell_height) % self.rows)
+
+    def rebuild(self, items, padding = 0.0):
+        """ Bucket items by position. padding widens every query, for
+            items that may have been further apart than their radii
+            """
+        self.padding = padding
+        cells = self.cells
+        cells.clear()
+        max_radius = 0.0
+        for item in items:
+            key = self.cell(item.x, item.y)
+            try:
+                cells[key].append(item)
+            except KeyError:
+                cells[key] = [item]
+            if item.scaled_radius > max_radius:
+                max_radius = item.scaled_radius
+        self.max_radius = max_radius
+
+    def span(self, center, reach, count):
+        """ Wrapped cell indices within reach cells of center """
+        if 2 * reach + 1 >= count:
+            return range(count)
+        return [index % count for index in range(center - reach, center + reach + 1)]
+
+    def query(self, item):
+        reach = item.scaled_radius + self.max_radius + self.padding
+        (column, row) = self.cell(item.x, item.y)
+        columns = self.span(column, int(math.ceil(reach / self.cell_width)),
+                            self.columns)
+        rows = self.span(row, int(math.ceil(reach / self.cell_height)),
+                         self.rows)
+
+        cells = self.cells
+        for i in columns:
+            for j in rows:
+                try:
+                    for other in cells[(i, j)]:
+                        yield other
+                except KeyError:
+                    pass
+
+
+class StaticBodies(object):
+    """ Many bodies that never move, indexed for nearby queries.
+
+        bodies is an (n, 4) array of x, y, radius and gravity. They are
+        bucketed by centre into a grid of cell_size cells over a playfield
+        of size that wraps at its edges, stored compressed: the bodies of
+        cell i are items[start[i]:start[i + 1]]. A query only looks at the
+        cells around the points it is given, so it costs the same however
+        large or full the rest of the level is.
+
+        The index can be built once and stored with the level, see
+        lava.levels.compile_level(); pass it back in as index.
+        """
+    def __init__(self, size, bodies, cell_size = 64, index = None):
+        (width, height) = size
+        self.size = size
+        self.bodies = numpy.asarray(bodies, dtype=numpy.float64).reshape(-1, 4)
+        self.columns = max(1, int(math.ceil(width / float(cell_size))))
+        self.rows = max(1, int(math.ceil(height / float(cell_size))))
+        self.cell_width = width / float(self.columns)
+        self.cell_height = height / float(self.rows)
+        self.max_radius = float(self.bodies[:, 2].max()) if len(self.bodies) else 0.0
+        if index is None or len(index[0]) != self.columns * self.rows + 1:
+            index = self.build()
+        (self.start, self.items) = index
+
+    def cells(self, x, y):
+        """ Flat cell number of each point x, y """
+        column = (x // self.cell_width).astype(numpy.intp) % self.columns
+        row = (y // self.cell_height).astype(numpy.intp) % self.rows
+        return row * self.columns + column
+
+    def build(self):
+        """ (start, items) of the bodies bucketed by cell """
+        cells = self.cells(self.bodies[:, 0], self.bodies[:, 1])
+        items = numpy.argsort(cells, kind="stable").astype(numpy.int32)
+        counts = numpy.bincount(cells, minlength=self.columns * self.rows)
+        start = numpy.zeros(len(counts) + 1, dtype=numpy.int32)
+        numpy.cumsum(counts, out=start[1:])
+        return (start, items)
+
+    def offsets(self, reach, cell, count):
+        """ Cell offsets to look at reach pixels either side, or every
+            cell once if that wraps all the way round
+            """
+        cells = int(math.ceil(reach / cell))
+        if 2 * cells + 1 >= count:
+            return None
+        return numpy.arange(-cells, cells + 1)
+
+    def near(self, x, y, reach):
+        """ (point, body) index arrays pairing each point x, y with every
+            body in the cells within reach of it, a superset of the bodies
+            within reach
+            """
+        if not len(x) or not len(self.bodies):
+            empty = numpy.zeros(0, dtype=numpy.intp)
+            return (empty, empty)
+
+        cells = self.cells(x, y)
+        (row, column) = divmod(cells, self.columns)
+        dx = self.offsets(reach, self.cell_width, self.columns)
+        dy = self.offsets(reach, self.cell_height, self.rows)
+        if dx is None:
+            columns = numpy.broadcast_to(numpy.arange(self.columns), (len(x), self.columns))
+        else:
+            columns = (column[:, None] + dx) % self.columns
+        if dy is None:
+            rows = numpy.broadcast_to(numpy.arange(self.rows), (len(x), self.rows))
+        else:
+            rows = (row[:, None] + dy) % self.rows
+        # (points, neighbouring cells)
+        neighbours = (rows[:, :, None] * self.columns + columns[:, None, :]).reshape(len(x), -1)
+
+        first = self.start[neighbours].ravel()
+        counts = self.start[neighbours + 1].ravel() - first
+        total = int(counts.sum())
+        # Expand each cell's run of items, point by point
+        ends = numpy.cumsum(counts)
+        runs = numpy.repeat(first - (ends - counts), counts)
+        bodies = self.items[runs + numpy.arange(total)]
+        points = numpy.repeat(numpy.arange(len(x)), counts.reshape(len(x), -1).sum(axis=1))
+        return (points, bodies)
+
+    def offset(self, points, bodies, x, y):
+        """ Wrapped (dx, dy) from each point to each paired body """
+        (width, height) = self.size
+        dx = (self.bodies[bodies, 0] - x[points] + width / 2) % width - width / 2
+        dy = (self.bodies[bodies, 1] - y[points] + height / 2) % height - height / 2
+        return (dx, dy)
+
+    def touching(self, x, y, radius, move_x, move_y):
+        """ (point, body) pairs where a circle of radius that moved by
+            move_x, move_y to reach x, y touched a body on the way
+            """
+        moved = numpy.hypot(move_x, move_y)
+        reach = float((radius + moved).max()) + self.max_radius if len(x) else 0.0
+        (points, bodies) = self.near(x, y, reach)
+        if not len(points):
+            return (points, bodies)
+
+        (dx, dy) = self.offset(points, bodies, x, y)
+        # Closest approach to the body along the move, from its start
+        (mx, my) = (move_x[points], move_y[points])
+        length = mx * mx + my * my
+        along = numpy.divide(dx * mx + dy * my, length,
+                             out=numpy.zeros_like(dx), where=length > 0)
+        t = numpy.clip(along + 1.0, 0.0, 1.0)
+        (cx, cy) = (dx + mx * (1.0 - t), dy + my * (1.0 - t))
+        hit_radius = radius[points] + self.bodies[bodies, 2]
+        hit = cx * cx + cy * cy < hit_radius * hit_radius
+        return (points[hit], bodies[hit])
+
+    def acceleration(self, x, y, cutoff):
+        """ The pull per ms at the points x, y of the bodies within cutoff
+            of their surface. Pulls are as in acceleration(), tapered
+            smoothly to nothing at the cutoff so none of them jumps as a
+            body comes into range
+            """
+        ax = numpy.zeros(len(x))
+        ay = numpy.zeros(len(x))
+        (points, bodies) = self.near(x, y, cutoff + self.max_radius)
+        if not len(points):
+            return (ax, ay)
+
+        (dx, dy) = self.offset(points, bodies, x, y)
+        length = numpy.hypot(dx, dy)
+        distance = length - self.bodies[bodies, 2]
+        r = distance / 200 + 1
+        taper = numpy.maximum(1.0 - (distance / cutoff) ** 2, 0.0) ** 2
+        force = numpy.where(distance > 0, self.bodies[bodies, 3] * taper / (r * r), 0.0)
+        scale = numpy.divide(force, length, out=numpy.zeros_like(force),
+                             where=length > 0)
+        ax += numpy.bincount(points, dx * scale, minlength=len(x))
+        ay += numpy.bincount(points, dy * scale, minlength=len(x))
+        return (ax, ay)
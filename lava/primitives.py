@@ -1,43 +1,236 @@
 import os
+import time
 import math
-import random
+import itertools
+import weakref
+import numpy
 import pygame
 from pygame.locals import *
 from OpenGL.GL import *
-from OpenGL.GLU import gluBuild2DMipmaps, gluOrtho2D
+from OpenGL.GLU import gluOrtho2D
 from lava.media import MediaManager
+from lava.profiler import FrameProfiler
+from lava.pacer import FramePacer
 
 mediaman = MediaManager()
 
-class GLSprite(pygame.sprite.Sprite):
+
+class TextureManager(object):
+    """ Shared, reference-counted GL textures keyed by image name.
+
+        Sprites acquire a texture by name and bind it through get(); the
+        image's cached mipmaps are uploaded the first time it is bound, and every
+        later sprite using the same image shares that texture id.
+        """
+    def __init__(self, media):
+        self.media = media
+        self.sources = {}
+        self.refs = {}
+        self.textures = {}
+
+    def acquire(self, file, directory = ''):
+        self.sources.setdefault(file, directory)
+        self.refs[file] = self.refs.get(file, 0) + 1
+        return file
+
+    def release(self, name):
+        self.refs[name] -= 1
+
+    def get(self, name):
+        try:
+            return self.textures[name]
+        except KeyError:
+            texture = self.upload(name)
+            self.textures[name] = texture
+            return texture
+
+    def upload(self, name):
+        levels = self.media.load_mipmaps(name, self.sources[name])
+
+        texture = glGenTextures(1)
+
+        glBindTexture(GL_TEXTURE_2D, texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER,
+                        GL_LINEAR_MIPMAP_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        for level, (width, height, textureData) in enumerate(levels):
+            glTexImage2D(GL_TEXTURE_2D, level, GL_RGBA, width, height, 0,
+                         GL_RGBA, GL_UNSIGNED_BYTE, textureData)
+
+        return texture
+
+    def preload(self, file, directory = ''):
+        """ Upload file ahead of the sprites that will acquire it """
+        self.sources.setdefault(file, directory)
+        self.get(file)
+
+    def purge(self):
+        """ Delete the textures no live sprite refers to anymore """
+        for name in [name for name in self.refs if self.refs[name] <= 0]:
+            texture = self.textures.pop(name, None)
+            if texture is not None:
+                glDeleteTextures([texture])
+            del self.refs[name]
+            del self.sources[name]
+
+
+textures = TextureManager(mediaman)
+
+
+class EntityStore(object):
+    """ Every entity that belongs to one World's or Scene's groups, in one
+        list.
+
+        Each group owns one tag bit and an entity's tags say which groups
+        it is in, so joining or leaving a group only sets or clears a bit
+        and keeps a count. An entity that leaves its last group leaves a
+        hole in the list; holes are closed in one pass once they make up
+        half of it. An entity is in one store's groups at a time.
+
+        The store, its groups and their entities go together, so a World
+        that is done with is collected as a whole and its entities never
+        slow down iterating another World's groups.
+        """
+    __slots__ = ('entities', 'holes', 'counts', 'next_tag')
+
+    def __init__(self):
+        self.entities = []
+        self.holes = 0
+        # Members of each tag
+        self.counts = {}
+        self.next_tag = 1
+
+    def new_tag(self):
+        tag = self.next_tag
+        self.next_tag <<= 1
+        self.counts[tag] = 0
+        return tag
+
+    def tag(self, entity, tag):
+        if entity.slot < 0:
+            if self.holes > 32 and self.holes * 2 > len(self.entities):
+                self.compact()
+            entity.store = self
+            entity.slot = len(self.entities)
+            self.entities.append(entity)
+        elif entity.store is not self:
+            raise ValueError("%s is already in another store's groups" % entity.name)
+        elif entity.tags & tag:
+            return
+        entity.tags |= tag
+        self.counts[tag] += 1
+
+    def untag(self, entity, tags):
+        if entity.store is not self:
+            return
+        tags &= entity.tags
+        if not tags:
+            return
+        entity.tags &= ~tags
+        counts = self.counts
+        while tags:
+            bit = tags & -tags
+            counts[bit] -= 1
+            tags ^= bit
+        if not entity.tags:
+            self.entities[entity.slot] = None
+            entity.slot = -1
+            entity.store = None
+            self.holes += 1
+
+    def clear(self, tag):
+        for entity in self.tagged(tag):
+            self.untag(entity, tag)
+
+    def tagged(self, tag):
+        """ The entities with tag, in the order they joined the store.
+            Entities that join during the iteration are left out, like
+            ones that leave before they are reached
+            """
+        entities = self.entities
+        for entity in itertools.islice(entities, len(entities)):
+            if entity is not None and entity.tags & tag:
+                yield entity
+
+    def compact(self):
+        # A new list, so iterations already under way carry on over the old
+        entities = [entity for entity in self.entities if entity is not None]
+        for slot, entity in enumerate(entities):
+            entity.slot = slot
+        self.entities = entities
+        self.holes = 0
+
+
+class GLSprite(object):
+    __slots__ = ('name', 'x', 'y', 'vx', 'vy', 'facing', 'width', 'height',
+                 'texture', 'prev_x', 'prev_y', 'prev_facing',
+                 'sweep_x', 'sweep_y', 'sweep_dx', 'sweep_dy', 'sweep_span',
+                 'sweep_tick', 'fast', 'ignore', 'scaled_radius',
+                 '_radius', '_scale', 'tags', 'slot', 'store', '__weakref__')
+    # Collision layer bits this sprite is on, and those it tests against
+    layer = 0
+    mask = 0
+
     def __init__(self):
-        pygame.sprite.Sprite.__init__(self)
         self.name = "GLsprite"
         self.x = 0
         self.y = 0
+        self.vx = 0.0
+        self.vy = 0.0
+        self.facing = 0.0
         self.width = 0
         self.height = 0
-        self.rect = None
-        self.__radius = 0.0
-        self.__scale = 1.0
+        self.texture = None
+        # State at the start of the last simulation step, for interpolation
+        self.prev_x = 0
+        self.prev_y = 0
+        self.prev_facing = 0.0
+        # Motion since the last collision pass, see World.sweep()
+        self.sweep_x = 0
+        self.sweep_y = 0
+        self.sweep_dx = 0.0
+        self.sweep_dy = 0.0
+        self.sweep_span = 1
+        self.sweep_tick = None
+        self.fast = False
+        # A sprite this one never collides with, such as a torpedo's own ship
+        self.ignore = None
+        self._radius = 0.0
+        self._scale = 1.0
+        self.scaled_radius = 0.0
+        # Groups this sprite is in, see EntityStore
+        self.tags = 0
+        self.slot = -1
+        self.store = None
         
     def get_radius(self):
-        return self.__radius
+        return self._radius
 
     def set_radius(self, radius):
-        self.__radius = radius
-        self.scaled_radius = radius * self.scale
+        self._radius = radius
+        self.scaled_radius = radius * self._scale
         
     radius = property(get_radius, set_radius)
     
     def get_scale(self):
-        return self.__scale
+        return self._scale
         
     def set_scale(self, scale):
-        self.__scale = scale
-        self.scaled_radius = self.radius * scale
+        self._scale = scale
+        self.scaled_radius = self._radius * scale
         
     scale = property(get_scale, set_scale)
+
+    def alive(self):
+        return self.tags != 0
+
+    def kill(self):
+        """ Leave every group """
+        if self.store is not None:
+            self.store.untag(self, self.tags)
+
+    def update(self, *args):
+        pass
     
     def draw(self):
         width = self.width / 2
@@ -49,7 +242,7 @@ class GLSprite(pygame.sprite.Sprite):
         glRotatef(self.facing, 0.0, 0.0, 1.0)
         glScalef(self.scale, self.scale, 1.0)
         
-        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glBindTexture(GL_TEXTURE_2D, textures.get(self.texture))
 
         glBegin(GL_QUADS)
         glTexCoord2f(0.0, 0.0); glVertex3f(-width, -height, 0.0)
@@ -58,41 +251,150 @@ class GLSprite(pygame.sprite.Sprite):
         glTexCoord2f(0.0, 1.0); glVertex3f(-width,  height, 0.0)
         glEnd()
         
-    def load_texture(self, image_ref):
-        textureSurface = image_ref
-        colorkey = textureSurface.get_at((0,0))
-        textureSurface.set_colorkey(colorkey)
-        
-        rect = textureSurface.get_rect()
-        textureData = pygame.image.tostring(textureSurface, "RGBA", 1)
-       
-        self.texture = glGenTextures(1)
-        
-        glBindTexture(GL_TEXTURE_2D, self.texture)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER,
-                        GL_LINEAR_MIPMAP_LINEAR)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-        gluBuild2DMipmaps(GL_TEXTURE_2D, GL_RGBA, textureSurface.get_width(),
-                          textureSurface.get_height(), GL_RGBA,
-                          GL_UNSIGNED_BYTE, textureData)
-                          
-        return rect.width, rect.height
+    def load_texture(self, file, directory = ''):
+        """ Share the texture for file, released when the sprite is freed """
+        self.texture = textures.acquire(file, directory)
+        weakref.finalize(self, textures.release, self.texture)
 
 
-class GLSpriteGroup(pygame.sprite.Group):
-    def __init__(self, *args):
-        pygame.sprite.Group.__init__(self, *args)
+class SpriteBatch(object):
+    """ Draws many textured quads sharing one texture in a single call.
 
-    def draw(self):
-        for sprite in self.iterate_sprites():
-            sprite.draw()
+        Quad corners are rotated, scaled and translated on the CPU with
+        NumPy and submitted as client-side vertex arrays.
+        """
+    corners = numpy.array([(-0.5, -0.5), (0.5, -0.5), (0.5, 0.5), (-0.5, 0.5)])
+
+    def __init__(self):
+        self.capacity = 0
+        self.texcoords = None
+
+    def reserve(self, count):
+        if count <= self.capacity:
+            return
+        while self.capacity < count:
+            self.capacity = max(64, self.capacity * 2)
+        self.texcoords = numpy.tile(self.corners + 0.5,
+                                    (self.capacity, 1)).astype(numpy.float32)
+
+    def vertices(self, x, y, facing, scale, width, height):
+        """ Return the (4 * n, 2) corners for n sprites, matching the
+            glTranslate/glRotatef/glScalef order of GLSprite.draw
+            """
+        angle = numpy.radians(facing)
+        cos = numpy.cos(angle) * scale
+        sin = numpy.sin(angle) * scale
+        cx = self.corners[:, 0] * width[:, None]
+        cy = self.corners[:, 1] * height[:, None]
+
+        vertices = numpy.empty((len(x), 4, 2), dtype=numpy.float32)
+        vertices[:, :, 0] = x[:, None] + cx * cos[:, None] - cy * sin[:, None]
+        vertices[:, :, 1] = y[:, None] + cx * sin[:, None] + cy * cos[:, None]
+        return vertices.reshape(-1, 2)
+
+    def draw(self, texture, x, y, facing, scale, width, height):
+        if not len(x):
+            return
+        self.submit(texture, self.vertices(x, y, facing, scale, width, height))
+
+    def submit(self, texture, vertices):
+        """ Draw the quads from vertices() """
+        count = len(vertices) // 4
+        self.reserve(count)
 
-    def iterate_sprites(self):
-        for sprite in self.sprites():
-            yield sprite
+        glLoadIdentity()
+        glBindTexture(GL_TEXTURE_2D, texture)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glVertexPointer(2, GL_FLOAT, 0, vertices)
+        glTexCoordPointer(2, GL_FLOAT, 0, self.texcoords)
+        glDrawArrays(GL_QUADS, 0, count * 4)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+
+
+class GLSpriteGroup(object):
+    """ A tag in an EntityStore; iterating a group walks the store's list
+        for sprites with its bit, without copying anything. Groups that
+        share sprites, such as a World's, share a store; a group given
+        none has one of its own
+        """
+    __slots__ = ('store', 'tag', 'batch')
+
+    def __init__(self, *sprites, store = None):
+        self.store = store if store is not None else EntityStore()
+        self.tag = self.store.new_tag()
+        self.batch = SpriteBatch()
+        self.add(*sprites)
+
+    def add(self, *sprites):
+        for sprite in sprites:
+            self.store.tag(sprite, self.tag)
+
+    def remove(self, *sprites):
+        for sprite in sprites:
+            self.store.untag(sprite, self.tag)
+
+    def has(self, *sprites):
+        for sprite in sprites:
+            if sprite not in self:
+                return False
+        return bool(sprites)
+
+    def __contains__(self, sprite):
+        return sprite.store is self.store and bool(sprite.tags & self.tag)
+
+    def __iter__(self):
+        return self.store.tagged(self.tag)
+
+    def __len__(self):
+        return self.store.counts[self.tag]
+
+    def sprites(self):
+        return list(self)
+
+    def empty(self):
+        self.store.clear(self.tag)
+
+    def update(self, *args):
+        for sprite in self.store.tagged(self.tag):
+            sprite.update(*args)
+
+    def draw(self, alpha = 1.0):
+        """ Batch plain GLSprites by texture, custom draw() is the fallback.
+
+            alpha blends each batched sprite from its state at the start of
+            the last simulation step (0.0) to its current state (1.0).
+            """
+        buckets = {}
+        custom = []
+        for sprite in self.store.tagged(self.tag):
+            if type(sprite).draw is GLSprite.draw:
+                buckets.setdefault(sprite.texture, []).append(
+                    (sprite.x, sprite.y, sprite.facing, sprite.scale,
+                     sprite.width, sprite.height,
+                     sprite.prev_x, sprite.prev_y, sprite.prev_facing))
+            else:
+                custom.append(sprite)
+
+        for texture in buckets:
+            data = numpy.array(buckets[texture], dtype=numpy.float64)
+            (x, y, facing, scale, width, height) = data[:, :6].T
+            if alpha < 1.0:
+                x = interpolate(data[:, 6], x, alpha)
+                y = interpolate(data[:, 7], y, alpha)
+                turn = (facing - data[:, 8] + 180.0) % 360.0 - 180.0
+                facing = facing - turn * (1.0 - alpha)
+            self.batch.draw(textures.get(texture), x, y, facing, scale,
+                            width, height)
+
+        for sprite in custom:
+            sprite.draw()
 
 
 class Background(GLSprite):
+    __slots__ = ()
+
     def __init__(self, point, image):
         (x, y) = point
         GLSprite.__init__(self)
@@ -101,7 +403,7 @@ class Background(GLSprite):
         self.y = y / 2
         self.width = x
         self.height = y
-        self.load_texture(mediaman.load_image(image))
+        self.load_texture(image)
 
     def draw(self):
         width = self.width / 2
@@ -111,7 +413,7 @@ class Background(GLSprite):
 
         glTranslate(self.x, self.y, -0.5)
 
-        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glBindTexture(GL_TEXTURE_2D, textures.get(self.texture))
         glColor(1.0, 1.0, 1.0, 0.5)
         glBegin(GL_QUADS)
         glTexCoord2f(0.0, 0.0); glVertex3f(-width, -height, 0.0)
@@ -141,56 +443,202 @@ class SpawnPoint(object):
 
 class ParticleEmitter(object):
     def __init__(self, parent, number):
-        x = 0
-        while x < number:
-            Particle(parent)
-            x += 1
+        parent.world.particles.emit(parent.x, parent.y, parent.facing, number)
+
+
+class ParticleSystem(GLSprite):
+    """ Fixed-capacity particle pool backed by NumPy arrays.
 
+        Live particles are kept packed at the front of the arrays, so one
+        vectorized step moves and ages all of them and dead slots are
+        reused by the next emit() without allocating new objects.
+        """
+    __slots__ = ('capacity', 'count', 'position', 'velocity', 'life', 'facings',
+                 'scales', 'sizes', 'batch', 'random')
 
-class Particle(GLSprite):
-    def __init__(self, parent):
+    def __init__(self, capacity = 4096, seed = None):
         GLSprite.__init__(self)
-        self.name = "particle"
+        self.name = "particles"
+        self.facing = 0.0
 
-        #self.load_texture(os.path.join('images', 'explode.gif'))
-        self.load_texture(mediaman.load_image('explode.gif', 'images'))
+        self.load_texture('explode.gif', 'images')
         self.width = self.height = 10
-        self.radius = 5
 
-        # Starting position
-        self.facing = parent.facing * random.random() * 100
-        self.x = parent.x
-        self.y = parent.y
+        self.capacity = capacity
+        self.count = 0
+        self.position = numpy.zeros((capacity, 2))
+        self.velocity = numpy.zeros((capacity, 2))
+        self.life = numpy.zeros(capacity)
+        self.facings = numpy.zeros(capacity)
+        self.scales = numpy.ones(capacity)
+        self.sizes = numpy.full(capacity, float(self.width))
+        self.batch = SpriteBatch()
+        self.random = numpy.random.default_rng(seed)
+
+    def emit(self, x, y, facing, number):
+        start = self.count
+        end = min(start + number, self.capacity)
+        number = end - start
+        if number <= 0:
+            return
 
-        # Velocity and TTL
-        self.life = 1000 
-        self.vx = random.uniform(-0.09, 0.09)
-        self.vy = random.uniform(-0.09, 0.09)
+        self.position[start:end] = (x, y)
+        self.velocity[start:end] = self.random.uniform(-0.09, 0.09, (number, 2))
+        self.life[start:end] = 1000
+        self.facings[start:end] = facing * self.random.random(number) * 100
+        self.count = end
 
-        # Add to world
-        parent.world.g_render.add(self)
-        
     def update(self, interval):
-        self.x += self.vx * interval
-        self.y += self.vy * interval
-        self.life -= interval
-        
-        if self.life <= 0:
-            self.kill()
+        count = self.count
+        if not count:
+            return
+
+        self.position[:count] += self.velocity[:count] * interval
+        self.life[:count] -= interval
+
+        alive = self.life[:count] > 0
+        remaining = int(numpy.count_nonzero(alive))
+        if remaining < count:
+            for array in (self.position, self.velocity, self.life, self.facings):
+                array[:remaining] = array[:count][alive]
+            self.count = remaining
+
+    def clear(self):
+        self.count = 0
 
     def draw(self):
+        count = self.count
+        if not count:
+            return
+
         glColor(1.0, 1.0, 1.0, 0.5)
-        GLSprite.draw(self)
+        self.batch.draw(textures.get(self.texture),
+                        self.position[:count, 0], self.position[:count, 1],
+                        self.facings[:count], self.scales[:count],
+                        self.sizes[:count], self.sizes[:count])
         glColor(1.0, 1.0, 1.0, 1.0)
 
 
+class FontAtlas(object):
+    """ Every printable ASCII glyph of one font and size, rendered once
+        into a single texture along with each glyph's size and UVs.
+
+        layout() turns a string into quads over that texture, so changing
+        text costs no rendering or uploads. The texture is uploaded the
+        first time it is bound.
+        """
+    characters = [chr(code) for code in range(32, 127)]
+
+    def __init__(self, font, size, padding = 1):
+        face = pygame.font.Font(os.path.join('fonts', font), size)
+        glyphs = [face.render(char, 1, (255, 255, 255))
+                  for char in self.characters]
+        self.line_height = face.get_height()
+
+        # Pack the glyphs into rows of a power-of-two sheet
+        sheet_width = 256
+        while sheet_width < max(glyph.get_width() for glyph in glyphs) + padding:
+            sheet_width *= 2
+        positions = []
+        x = y = row_height = 0
+        for glyph in glyphs:
+            (width, height) = glyph.get_size()
+            if x + width + padding > sheet_width:
+                x = 0
+                y += row_height + padding
+                row_height = 0
+            positions.append((x, y))
+            x += width + padding
+            row_height = max(row_height, height)
+        sheet_height = power2(y + row_height + padding)
+
+        self.surface = pygame.Surface((sheet_width, sheet_height), SRCALPHA, 32)
+        self.surface.fill((255, 255, 255, 0))
+        self.glyphs = {}
+        for char, glyph, (x, y) in zip(self.characters, glyphs, positions):
+            self.surface.blit(glyph, (x, y))
+            (width, height) = glyph.get_size()
+            # The sheet is uploaded flipped, so v runs up from the bottom
+            self.glyphs[char] = (width, height,
+                                 x / float(sheet_width),
+                                 1.0 - (y + height) / float(sheet_height),
+                                 (x + width) / float(sheet_width),
+                                 1.0 - y / float(sheet_height))
+        self.texture = None
+
+    def bind(self):
+        if self.texture is None:
+            textureData = pygame.image.tostring(self.surface, "RGBA", 1)
+            self.texture = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_2D, self.texture)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.surface.get_width(),
+                         self.surface.get_height(), 0, GL_RGBA,
+                         GL_UNSIGNED_BYTE, textureData)
+        else:
+            glBindTexture(GL_TEXTURE_2D, self.texture)
+
+    def layout(self, string):
+        """ Return (vertices, texcoords, width, height) for string, with
+            the quads centered on the origin
+            """
+        glyphs = [self.glyphs.get(char) or self.glyphs['?'] for char in string]
+        metrics = numpy.array(glyphs, dtype=numpy.float32).reshape(-1, 6)
+        widths = metrics[:, 0]
+        width = float(widths.sum())
+        height = float(max(self.line_height, metrics[:, 1].max(initial=0)))
+
+        left = numpy.cumsum(widths) - widths - width / 2
+        right = left + widths
+        bottom = -height / 2
+        top = height / 2
+
+        vertices = numpy.empty((len(glyphs), 4, 2), dtype=numpy.float32)
+        vertices[:, 0] = numpy.stack((left, numpy.full_like(left, bottom)), -1)
+        vertices[:, 1] = numpy.stack((right, numpy.full_like(left, bottom)), -1)
+        vertices[:, 2] = numpy.stack((right, numpy.full_like(left, top)), -1)
+        vertices[:, 3] = numpy.stack((left, numpy.full_like(left, top)), -1)
+
+        (u0, v0, u1, v1) = metrics[:, 2:].T
+        texcoords = numpy.empty((len(glyphs), 4, 2), dtype=numpy.float32)
+        texcoords[:, 0] = numpy.stack((u0, v0), -1)
+        texcoords[:, 1] = numpy.stack((u1, v0), -1)
+        texcoords[:, 2] = numpy.stack((u1, v1), -1)
+        texcoords[:, 3] = numpy.stack((u0, v1), -1)
+
+        return (vertices.reshape(-1, 2), texcoords.reshape(-1, 2), width, height)
+
+
+class FontManager(object):
+    """ One FontAtlas per (font, size), built the first time it is asked for """
+    def __init__(self):
+        self.atlases = {}
+
+    def load(self, font, size):
+        try:
+            return self.atlases[(font, size)]
+        except KeyError:
+            pygame.font.init()
+            atlas = self.atlases[(font, size)] = FontAtlas(font, size)
+            return atlas
+
+
+fonts = FontManager()
+
+
 class GLText(GLSprite):
+    __slots__ = ('string', 'anchor', 'size', 'valign', 'halign', 'vertices',
+                 'texcoords', 'font')
+
     def __init__(self, string, x, y, font='Vera.ttf', size=14,
                  valign='center', halign='center'):
         GLSprite.__init__(self)
         self.name = 'Text'
         self.string = ''
 
+        # x is where the text is anchored, halign says which edge is there
+        self.anchor = x
         self.x = x
         self.y = y
         self.size = size
@@ -200,65 +648,117 @@ class GLText(GLSprite):
         self.height = 0
         self.valign = valign
         self.halign = halign
+        self.vertices = None
+        self.texcoords = None
 
-        pygame.font.init()
-        self.font = pygame.font.Font(os.path.join('fonts', font), size)
+        self.font = fonts.load(font, size)
         self.update_string(string)
 
     def update_string(self, new_string):
-        if new_string == "" or new_string == None or self.string == new_string:
+        if new_string == "" or new_string == None or self.string == str(new_string):
             return
         self.string = str(new_string)
-        self.text = self.font.render(self.string, 1, (255, 255, 255))
-        (self.width, self.height) = self.load_texture()
+        (self.vertices, self.texcoords, self.width, self.height) = \
+            self.font.layout(self.string)
 
         if self.halign == 'left':
-            self.x += self.width / 2
+            self.x = self.anchor + self.width / 2
         elif self.halign == 'right':
-            self.x -= self.width / 2
-
-    def load_texture(self):
-        text = self.text
-        rect = text.get_rect()
-        width = power2(rect.width)
-        height = power2(rect.height)
-        self.xTexScale = rect.width / float(width)
-        self.yTexScale = rect.height / float(height)
-
-        surface = pygame.Surface((width, height), SRCALPHA, 32)
-        surface.blit(text, (0, 0))
-        textureData = pygame.image.tostring(surface, "RGBA", 1)
-        self.texture = glGenTextures(1)
-
-        glBindTexture(GL_TEXTURE_2D, self.texture)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width,
-                     height, 0, GL_RGBA, GL_UNSIGNED_BYTE, textureData)
-
-        return rect.width, rect.height
+            self.x = self.anchor - self.width / 2
 
     def draw(self):
-        width = self.width / 2
-        height = self.height / 2
-        xTex = self.xTexScale
-        yTex = 1.0 - self.yTexScale
-        
+        if self.vertices is None:
+            return
+
         glLoadIdentity()
 
         glTranslate(self.x, self.y, 0.0)
         glRotatef(self.facing, 0.0, 0.0, 1.0)
         glScalef(self.scale, self.scale, 1.0)
-        
-        glBindTexture(GL_TEXTURE_2D, self.texture)
 
-        glBegin(GL_QUADS)
-        glTexCoord2f(0.0, yTex); glVertex3f(-width, -height, 0.0)
-        glTexCoord2f(xTex, yTex); glVertex3f( width, -height, 0.0)
-        glTexCoord2f(xTex, 1.0); glVertex3f( width,  height, 0.0)
-        glTexCoord2f(0.0, 1.0); glVertex3f(-width,  height, 0.0)
-        glEnd()
+        self.font.bind()
+
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glVertexPointer(2, GL_FLOAT, 0, self.vertices)
+        glTexCoordPointer(2, GL_FLOAT, 0, self.texcoords)
+        glDrawArrays(GL_QUADS, 0, len(self.vertices))
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+
+
+class ProfilerGraph(GLSprite):
+    """ Stacked bar graph of the profiler's recent frames, one colour per
+        phase, with a legend of the average ms for each phase
+        """
+    __slots__ = ('profiler', 'frames', 'ms_height', 'legend')
+    colors = [(0.9, 0.3, 0.3), (0.3, 0.9, 0.3), (0.3, 0.5, 1.0),
+              (0.9, 0.9, 0.3), (0.9, 0.3, 0.9), (0.3, 0.9, 0.9),
+              (1.0, 0.6, 0.2), (0.7, 0.7, 0.7)]
+
+    def __init__(self, profiler, x, y, frames = 200, ms_height = 4.0):
+        GLSprite.__init__(self)
+        self.name = "profiler"
+        self.profiler = profiler
+        self.x = x
+        self.y = y
+        self.facing = 0
+        self.frames = frames
+        # Pixels of bar per ms, so a 16.7 ms frame is about 67 px tall
+        self.ms_height = ms_height
+        self.legend = []
+
+    def refresh_legend(self):
+        """ Rebuild the legend text, cheap enough to call about once a second """
+        (frames, samples) = self.profiler.recent(self.frames)
+        if not len(frames):
+            return
+        means = samples.mean(axis=0)
+        while len(self.legend) < len(means):
+            index = len(self.legend)
+            self.legend.append(GLText(" ", self.x, self.y - 14 * (index + 1),
+                                      size=12, halign='left'))
+        for phase, text, mean in zip(self.profiler.phases, self.legend, means):
+            text.update_string("%s %.2f ms" % (phase, mean))
+
+    def draw(self):
+        (frames, samples) = self.profiler.recent(self.frames)
+        count = len(frames)
+        if count:
+            # Stack the phases of each frame into one column of quads
+            tops = numpy.cumsum(samples, axis=1) * self.ms_height + self.y
+            bottoms = tops - samples * self.ms_height
+            left = self.x + numpy.arange(count, dtype=numpy.float64)[:, None]
+            left = numpy.broadcast_to(left, tops.shape)
+
+            vertices = numpy.empty(tops.shape + (4, 2), dtype=numpy.float32)
+            vertices[..., 0, :] = numpy.stack((left, bottoms), -1)
+            vertices[..., 1, :] = numpy.stack((left + 1, bottoms), -1)
+            vertices[..., 2, :] = numpy.stack((left + 1, tops), -1)
+            vertices[..., 3, :] = numpy.stack((left, tops), -1)
+
+            palette = numpy.array([self.colors[i % len(self.colors)] + (0.8,)
+                                   for i in range(tops.shape[1])],
+                                  dtype=numpy.float32)
+            colors = numpy.empty(tops.shape + (4, 4), dtype=numpy.float32)
+            colors[...] = palette[None, :, None, :]
+
+            glLoadIdentity()
+            glDisable(GL_TEXTURE_2D)
+            glEnableClientState(GL_VERTEX_ARRAY)
+            glEnableClientState(GL_COLOR_ARRAY)
+            glVertexPointer(2, GL_FLOAT, 0, vertices.reshape(-1, 2))
+            glColorPointer(4, GL_FLOAT, 0, colors.reshape(-1, 4))
+            glDrawArrays(GL_QUADS, 0, vertices.shape[0] * vertices.shape[1] * 4)
+            glDisableClientState(GL_COLOR_ARRAY)
+            glDisableClientState(GL_VERTEX_ARRAY)
+            glEnable(GL_TEXTURE_2D)
+            glColor(1.0, 1.0, 1.0, 1.0)
+
+        for index, text in enumerate(self.legend):
+            glColor(*(self.colors[index % len(self.colors)] + (1.0,)))
+            text.draw()
+        glColor(1.0, 1.0, 1.0, 1.0)
 
 
 class Console(object):
@@ -268,41 +768,128 @@ class Console(object):
     def write(self, text):
         print(text)
 
+    def event(self, kind, text, **fields):
+        """ A typed game event, see lava.eventlog.EventLog; plain consoles
+            just write its text
+            """
+        self.write(text)
+
+
+class Quiet(Console):
+    """ A console that drops everything, for headless runs that keep
+        stdout for their own output
+        """
+    def write(self, text):
+        pass
+
+
+class ConsoleView(GLSprite):
+    """ The last lines of an EventLog, newest at the bottom """
+    __slots__ = ('log', 'version', 'texts')
+
+    def __init__(self, log, x, y, size = 12):
+        GLSprite.__init__(self)
+        self.name = "console"
+        self.log = log
+        self.x = x
+        self.y = y
+        self.facing = 0
+        self.version = None
+        spacing = size + 2
+        self.texts = [GLText(" ", x, y + spacing * (log.lines.maxlen - 1 - i),
+                             size=size, halign='left')
+                      for i in range(log.lines.maxlen)]
+
+    def draw(self):
+        if self.version != self.log.version:
+            self.version = self.log.version
+            lines = list(self.log.lines)
+            lines = [" "] * (len(self.texts) - len(lines)) + lines
+            for text, line in zip(self.texts, lines):
+                text.update_string(line)
+        for text in self.texts:
+            text.draw()
+
+
+class WindowTarget(object):
+    """ Where a Scene draws by default: the pygame window's back buffer.
+        See lava.offscreen.FramebufferTarget for drawing without a window
+        """
+    def begin(self):
+        pass
+
+    def present(self):
+        pygame.display.flip()
+
 
 class Scene(object):
+    # Length of one fixed simulation step in ms
+    timestep = 25
+
     def __init__(self, screen_size):
         self.size = screen_size
         self.blend = False
-        self.g_background = GLSpriteGroup()
-        self.g_hud = GLSpriteGroup()
-        self.g_render = GLSpriteGroup()
+        self.entities = EntityStore()
+        self.g_background = GLSpriteGroup(store = self.entities)
+        self.g_hud = GLSpriteGroup(store = self.entities)
+        self.g_render = GLSpriteGroup(store = self.entities)
+        self.profiler = FrameProfiler()
+        self.pacer = FramePacer()
+        self.target = WindowTarget()
+        # Only draw frames in which the simulation advanced
+        self.render_on_step = False
         
     def run(self):
+        """ Run static_tick() in fixed timestep steps and draw once per
+            frame in between, however long the frames take. Frames are
+            paced by self.pacer; with render_on_step, frames without a
+            step are skipped and the loop waits for the next step instead
+            """
         self.clock = pygame.time.Clock()
         self.running = True
-        last_tick = this_tick = pygame.time.get_ticks()
         timer = 0
+        # When the next step is due, after a pass that skipped its frame
+        due = None
         
         while self.running:
-            interval = self.clock.tick()
-            timer += interval
-            self.tick(interval)
-            if timer >= 25:
-                self.static_tick(timer)
-                timer = 0
-
-    def tick(self, timer):
-        self.draw_screen()
+            if due is None:
+                self.pacer.wait()
+            else:
+                self.pacer.wait_until(due)
+            self.profiler.mark("idle")
+            timer += self.clock.tick()
+            self.profiler.begin()
+            # Drop time we can't catch up on rather than spiral after a stall
+            timer = min(timer, self.timestep * 10)
+            steps = 0
+            while timer >= self.timestep and self.running:
+                self.static_tick(self.timestep)
+                timer -= self.timestep
+                steps += 1
+            if not self.running:
+                break
+            if steps or not self.render_on_step:
+                due = None
+                self.tick(timer / float(self.timestep))
+            else:
+                due = time.perf_counter() + (self.timestep - timer) / 1000.0
+
+    def tick(self, alpha):
+        self.pacer.frame()
+        self.draw_screen(alpha)
 
     def static_tick(self, timer):
         pass
         
-    def draw_screen(self):
+    def draw_screen(self, alpha = 1.0):
+        self.target.begin()
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         self.g_background.draw()
-        self.g_render.draw()
+        self.g_render.draw(alpha)
         self.g_hud.draw()
-        pygame.display.flip()
+        self.profiler.mark("draw")
+        self.target.present()
+        self.profiler.mark("flip")
         
 
 def power2(x):
@@ -314,6 +901,16 @@ def power2(x):
     p = math.log(x) / math.log(2)
     return 2**int(math.ceil(p))        
 
+def interpolate(previous, current, alpha, limit = 100.0):
+    """ Blend arrays of coordinates from previous to current by alpha.
+
+    Anything that moved further than limit in one step wrapped around the
+    playfield or was teleported, so it is drawn where it is now.
+    """
+    moved = current - previous
+    return numpy.where(numpy.abs(moved) < limit,
+                       current - moved * (1.0 - alpha), current)
+
 def sincos(angle, speed):
     vx = speed*math.cos(angle)
     vy = speed*math.sin(angle)
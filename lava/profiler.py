@@ -0,0 +1,75 @@
+import time
+import numpy
+
+
+class FrameProfiler(object):
+    """ Time spent in each phase of a frame, kept in a ring buffer.
+
+        begin() starts a frame and every mark(phase) charges the time since
+        the previous mark to that phase. Phases are registered the first
+        time they are marked. While disabled both return straight away.
+        totals() has the time charged to each phase since the start, for
+        runs longer than the ring buffer.
+        """
+    def __init__(self, capacity = 600, max_phases = 16):
+        self.enabled = False
+        self.capacity = capacity
+        self.samples = numpy.zeros((capacity, max_phases))
+        self.sums = numpy.zeros(max_phases)
+        self.frames = numpy.zeros(capacity, dtype=numpy.int64)
+        self.phases = []
+        self.columns = {}
+        self.frame = 0
+        self.row = 0
+        self.last = 0.0
+
+    def begin(self):
+        if not self.enabled:
+            return
+        self.frame += 1
+        self.row = self.frame % self.capacity
+        self.samples[self.row] = 0.0
+        self.frames[self.row] = self.frame
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        try:
+            column = self.columns[phase]
+        except KeyError:
+            column = self.columns[phase] = len(self.phases)
+            self.phases.append(phase)
+        self.samples[self.row, column] += now - self.last
+        self.sums[column] += now - self.last
+        self.last = now
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        if self.enabled:
+            self.begin()
+        return self.enabled
+
+    def totals(self):
+        """ {phase: seconds} over every frame so far """
+        return dict(zip(self.phases, self.sums.tolist()))
+
+    def recent(self, count = None):
+        """ (frames, ms) for the last count complete frames, oldest first """
+        count = min(count or self.capacity, self.frame - 1, self.capacity - 1)
+        if count <= 0:
+            return (self.frames[:0], self.samples[:0, :len(self.phases)])
+        rows = numpy.arange(self.frame - count, self.frame) % self.capacity
+        return (self.frames[rows],
+                self.samples[rows, :len(self.phases)] * 1000.0)
+
+    def dump(self, filename):
+        """ Write the buffered frames as CSV, one row per frame, in ms """
+        (frames, samples) = self.recent()
+        with open(filename, 'w') as f:
+            f.write(",".join(["frame"] + self.phases + ["total"]) + "\n")
+            for frame, row in zip(frames.tolist(), samples.tolist()):
+                f.write(",".join([str(frame)] + ["%.3f" % ms for ms in row] +
+                                 ["%.3f" % sum(row)]) + "\n")
+        return len(frames)
@@ -0,0 +1,746 @@
+#!/usr/bin/env python
+""" Networked play: an authoritative server streaming world snapshots
+over UDP to clients that send back their control bits.
+
+Snapshots are quantized binary records, delta-encoded against the last
+snapshot each client acknowledged. Each packet is capped at PACKET_BUDGET
+bytes, so bandwidth per client stays flat however many torpedoes are in
+flight. Changes that don't fit are sent in later packets, rotating through
+the entities.
+
+A level's static bodies never move, so they are left out of the snapshots
+and sent to each client once per level, in chunks that fit the same
+budget. A client asks again for any chunk it hasn't got.
+
+    python netplay.py server --level level2
+    python netplay.py client 192.168.1.10 --name Alice
+    python netplay.py loopback --clients 2 --seconds 10
+    python netplay.py loopback --seconds 20 --drop-acks 0.01
+"""
+import sys
+import time
+import struct
+import socket
+import random
+import argparse
+
+from actors import *
+from world import World, match_seed
+from lava.levels import LevelManager
+
+PORT = 27960
+PACKET_BUDGET = 1200
+HISTORY = 64
+TIMEOUT = 5.0
+
+# Packet types
+CONNECT = 1
+ACCEPT = 2
+INPUT = 3
+SNAPSHOT = 4
+DISCONNECT = 5
+BODIES = 6
+BODIES_REQUEST = 7
+
+# Entity kinds
+SHIP = 1
+STAR = 2
+TORPEDO = 3
+
+# Entity ids by kind
+SHIP_IDS = 0
+STAR_IDS = 64
+TORPEDO_IDS = 256
+
+ALIVE = 0x80
+
+PACKET = struct.Struct("<B")
+# ship index, timestep, width, height
+ACCEPT_BODY = struct.Struct("<BHHH")
+# input sequence, last snapshot received, control bits
+INPUT_BODY = struct.Struct("<HHB")
+# snapshot id, baseline id, level name length, record count
+SNAPSHOT_BODY = struct.Struct("<HHBH")
+# entity id, mask of the fields that follow (0 removes the entity)
+RECORD = struct.Struct("<HB")
+# level name length, chunk index, chunk count, body count
+BODIES_BODY = struct.Struct("<BHHH")
+# x, y and radius of a static body (1/16 px)
+BODY = struct.Struct("<HHH")
+# chunk index
+REQUEST_BODY = struct.Struct("<H")
+# Seconds between a client's requests for missing chunks
+REQUEST_INTERVAL = 0.25
+
+# One struct per entity field, in mask bit order: kind, x, y (1/16 px),
+# vx, vy (1/10000 px per ms), facing (1/65536 turn), flags (alive bit and
+# scale in 1/16ths) and life/score
+FIELDS = [struct.Struct(fmt) for fmt in ("<B", "<H", "<H", "<h", "<h",
+                                          "<H", "<B", "<bh")]
+FULL = (1 << len(FIELDS)) - 1
+
+
+def clamp(value, low, high):
+    return max(low, min(high, int(round(value))))
+
+
+def quantize(kind, sprite, alive = True):
+    """ The entity's state as a tuple of the integers FIELDS carry """
+    stats = (0, 0)
+    if kind == SHIP:
+        stats = (clamp(sprite.life, -128, 127), clamp(sprite.score, -32768, 32767))
+    flags = clamp(sprite.scale * 16, 0, 127)
+    if alive:
+        flags |= ALIVE
+    return (kind,
+            clamp(sprite.x * 16, 0, 65535),
+            clamp(sprite.y * 16, 0, 65535),
+            clamp(sprite.vx * 10000, -32767, 32767),
+            clamp(sprite.vy * 10000, -32767, 32767),
+            int(round(sprite.facing / 360.0 * 65536)) & 0xFFFF,
+            flags,
+            stats)
+
+
+def capture(world):
+    """ {entity id: quantized state} for everything a client draws """
+    state = {}
+    for index, ship in enumerate(world.ships):
+        state[SHIP_IDS + index] = quantize(SHIP, ship, ship.alive())
+    for index, star in enumerate(world.g_stars):
+        state[STAR_IDS + index] = quantize(STAR, star)
+    for index, torpedo in enumerate(world.torpedoes.torpedoes):
+        if torpedo.alive():
+            state[TORPEDO_IDS + index] = quantize(TORPEDO, torpedo)
+    return state
+
+
+def encode_entity(entity, mask, values):
+    data = [RECORD.pack(entity, mask)]
+    for bit, field in enumerate(FIELDS):
+        if mask & (1 << bit):
+            value = values[bit]
+            data.append(field.pack(*value) if isinstance(value, tuple)
+                        else field.pack(value))
+    return b"".join(data)
+
+
+def delta(baseline, current, order, budget):
+    """ Encode current against baseline, most important entities first,
+        until budget bytes are used. Returns (records, count, sent) where
+        sent is the state the receiver will have after applying them.
+        """
+    sent = dict(baseline)
+    records = []
+    count = 0
+    size = 0
+    for entity in order:
+        values = current.get(entity)
+        previous = baseline.get(entity)
+        if values is None:
+            if previous is None:
+                continue
+            record = RECORD.pack(entity, 0)
+        else:
+            if previous is None:
+                mask = FULL
+            else:
+                mask = 0
+                for bit in range(len(FIELDS)):
+                    if values[bit] != previous[bit]:
+                        mask |= 1 << bit
+                if not mask:
+                    continue
+            record = encode_entity(entity, mask, values)
+
+        if size + len(record) > budget:
+            continue
+        records.append(record)
+        size += len(record)
+        count += 1
+        if values is None:
+            del sent[entity]
+        else:
+            sent[entity] = values
+    return (b"".join(records), count, sent)
+
+
+def apply_delta(baseline, data, offset, count):
+    """ Rebuild a snapshot from its baseline and count encoded records """
+    state = dict(baseline)
+    for i in range(count):
+        (entity, mask) = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if not mask:
+            state.pop(entity, None)
+            continue
+        values = list(state.get(entity, (0, 0, 0, 0, 0, 0, 0, (0, 0))))
+        for bit, field in enumerate(FIELDS):
+            if mask & (1 << bit):
+                value = field.unpack_from(data, offset)
+                offset += field.size
+                values[bit] = value if len(value) > 1 else value[0]
+        state[entity] = tuple(values)
+    return state
+
+
+def pack_bodies(level, field):
+    """ The BODIES packets carrying field's static bodies, or a single
+        empty one when the level has none
+        """
+    name = level.encode("utf-8")
+    header = PACKET.size + BODIES_BODY.size + len(name)
+    per_chunk = (PACKET_BUDGET - header) // BODY.size
+    records = []
+    if field is not None:
+        for (x, y, radius, gravity) in field.bodies.bodies.tolist():
+            records.append(BODY.pack(clamp(x * 16, 0, 65535), clamp(y * 16, 0, 65535),
+                                     clamp(radius * 16, 0, 65535)))
+    chunks = [records[start:start + per_chunk]
+              for start in range(0, len(records), per_chunk)] or [[]]
+    return [PACKET.pack(BODIES) +
+            BODIES_BODY.pack(len(name), index, len(chunks), len(chunk)) +
+            name + b"".join(chunk)
+            for index, chunk in enumerate(chunks)]
+
+
+class RemoteClient(object):
+    """ The server's view of one connected client """
+    def __init__(self, address, ship):
+        self.address = address
+        self.ship = ship
+        self.acked = None
+        self.sent = {}
+        self.rotation = 0
+        self.last_heard = time.time()
+        self.bytes_sent = 0
+        self.packets_sent = 0
+
+
+class Server(object):
+    """ Runs the World and streams snapshots to every client """
+    def __init__(self, level, size = (800, 600), port = PORT, players = 2,
+                 seed = None, host = "", console = None):
+        self.world = World(size, level, console = console, seed = seed)
+        if not 1 <= players <= len(self.world.ships):
+            raise ValueError("a world has room for 1 to %d players, not %d" %
+                             (len(self.world.ships), players))
+        self.players = players
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.setblocking(False)
+        self.clients = {}
+        self.snapshot = 0
+        self.step_time = 0.0
+        self.level = None
+        self.bodies = []
+
+    def receive(self):
+        while True:
+            try:
+                (data, address) = self.socket.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionResetError:
+                continue
+            if not data:
+                continue
+            kind = data[0]
+            client = self.clients.get(address)
+            if kind == CONNECT:
+                self.connect(address, data[1:].decode("utf-8", "replace"))
+            elif client is None:
+                continue
+            elif kind == INPUT:
+                (sequence, ack, controls) = INPUT_BODY.unpack_from(data, 1)
+                client.last_heard = time.time()
+                if ack in client.sent:
+                    client.acked = ack
+                ships = self.world.ships
+                if client.ship < len(ships):
+                    ships[client.ship].controls = controls
+            elif kind == BODIES_REQUEST:
+                (index,) = REQUEST_BODY.unpack_from(data, 1)
+                if index < len(self.bodies):
+                    self.socket.sendto(self.bodies[index], address)
+            elif kind == DISCONNECT:
+                self.drop(client)
+
+    def connect(self, address, name):
+        client = self.clients.get(address)
+        if client is None:
+            taken = set(other.ship for other in self.clients.values())
+            free = [index for index in range(self.players) if index not in taken]
+            if not free:
+                return
+            client = self.clients[address] = RemoteClient(address, free[0])
+            self.world.console.event("join", "%s joined as player %d" % (name or address[0], free[0] + 1),
+                                     player=free[0] + 1, address=address[0])
+        world = self.world
+        self.socket.sendto(PACKET.pack(ACCEPT) +
+                           ACCEPT_BODY.pack(client.ship, world.timestep,
+                                            world.size[0], world.size[1]),
+                           address)
+        self.send_bodies(address)
+
+    def send_bodies(self, address):
+        for packet in self.bodies:
+            self.socket.sendto(packet, address)
+
+    def drop(self, client):
+        ships = self.world.ships
+        if client.ship < len(ships):
+            ships[client.ship].controls = 0
+        del self.clients[client.address]
+
+    def broadcast(self):
+        world = self.world
+        if world.level is not self.level:
+            # Ahead of the first snapshot of the level
+            self.level = world.level
+            self.bodies = pack_bodies(world.level_file, world.bodies)
+            for address in self.clients:
+                self.send_bodies(address)
+
+        self.snapshot = (self.snapshot + 1) & 0xFFFF
+        current = capture(world)
+        level = world.level_file.encode("utf-8")
+        now = time.time()
+        for client in list(self.clients.values()):
+            if now - client.last_heard > TIMEOUT:
+                self.drop(client)
+                continue
+            self.send(client, current, level)
+
+    def send(self, client, current, level):
+        baseline_id = client.acked
+        if baseline_id not in client.sent:
+            # Never acked, or acked too long ago to still be in the history:
+            # start over from a full snapshot the client needs no baseline for
+            baseline_id = client.acked = None
+        baseline = client.sent.get(baseline_id, {})
+
+        # Ships and stars always lead; the rest take turns at the front
+        entities = sorted(set(current) | set(baseline))
+        fixed = [entity for entity in entities if entity < TORPEDO_IDS]
+        rest = [entity for entity in entities if entity >= TORPEDO_IDS]
+        if rest:
+            client.rotation %= len(rest)
+            rest = rest[client.rotation:] + rest[:client.rotation]
+            client.rotation += 1
+
+        header = (PACKET.size + SNAPSHOT_BODY.size + len(level))
+        (records, count, sent) = delta(baseline, current, fixed + rest,
+                                       PACKET_BUDGET - header)
+        packet = (PACKET.pack(SNAPSHOT) +
+                  SNAPSHOT_BODY.pack(self.snapshot,
+                                     baseline_id if baseline_id is not None else 0xFFFF,
+                                     len(level), count) +
+                  level + records)
+        self.socket.sendto(packet, client.address)
+        client.bytes_sent += len(packet)
+        client.packets_sent += 1
+
+        client.sent[self.snapshot] = sent
+        # Forget snapshots the client can no longer ack usefully
+        stale = (self.snapshot - HISTORY) & 0xFFFF
+        client.sent.pop(stale, None)
+
+    def tick(self):
+        self.receive()
+        start = time.perf_counter()
+        self.world.step()
+        self.broadcast()
+        self.step_time += time.perf_counter() - start
+
+    def serve(self, duration = None):
+        """ Step in real time until the match ends or duration seconds pass """
+        interval = self.world.timestep / 1000.0
+        start = next_step = time.time()
+        while self.world.running:
+            now = time.time()
+            if duration is not None and now - start >= duration:
+                break
+            if now < next_step:
+                self.receive()
+                time.sleep(min(0.002, next_step - now))
+                continue
+            self.tick()
+            next_step += interval
+
+    def close(self):
+        self.socket.close()
+
+
+class Client(object):
+    """ Sends control bits to a server and rebuilds its snapshots """
+    def __init__(self, host, port = PORT, name = ""):
+        self.address = (host, port)
+        self.name = name
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.ship = None
+        self.size = None
+        self.timestep = None
+        self.snapshots = {}
+        self.latest = None
+        self.state = {}
+        self.level = None
+        self.sequence = 0
+        self.bytes_received = 0
+        # Static bodies of body_level, by chunk, and how many chunks it has
+        self.body_level = None
+        self.body_chunks = {}
+        self.body_count = None
+        self.body_requested = 0.0
+
+    def connect(self, timeout = 5.0):
+        deadline = time.time() + timeout
+        while self.ship is None and time.time() < deadline:
+            self.socket.sendto(PACKET.pack(CONNECT) + self.name.encode("utf-8"),
+                               self.address)
+            time.sleep(0.1)
+            self.receive()
+        return self.ship is not None
+
+    def receive(self):
+        while True:
+            try:
+                data = self.socket.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionResetError:
+                continue
+            if not data:
+                continue
+            self.bytes_received += len(data)
+            if data[0] == ACCEPT:
+                (self.ship, self.timestep, width,
+                 height) = ACCEPT_BODY.unpack_from(data, 1)
+                self.size = (width, height)
+            elif data[0] == SNAPSHOT:
+                self.read_snapshot(data)
+            elif data[0] == BODIES:
+                self.read_bodies(data)
+
+    def read_bodies(self, data):
+        offset = PACKET.size
+        (length, index, chunks, count) = BODIES_BODY.unpack_from(data, offset)
+        offset += BODIES_BODY.size
+        level = data[offset:offset + length].decode("utf-8")
+        offset += length
+        if level != self.body_level:
+            self.body_level = level
+            self.body_chunks = {}
+        self.body_count = chunks
+        self.body_chunks[index] = [BODY.unpack_from(data, offset + BODY.size * i)
+                                   for i in range(count)]
+
+    def request_bodies(self):
+        """ Ask again for the chunks of the level's bodies that went missing """
+        now = time.time()
+        if self.level is None or now - self.body_requested < REQUEST_INTERVAL:
+            return
+        if self.body_level != self.level:
+            missing = [0]
+        else:
+            missing = [index for index in range(self.body_count)
+                       if index not in self.body_chunks]
+        if missing:
+            self.body_requested = now
+        for index in missing:
+            self.socket.sendto(PACKET.pack(BODIES_REQUEST) + REQUEST_BODY.pack(index),
+                               self.address)
+
+    def static_bodies(self):
+        """ [(x, y, radius), ...] for the level being played, or None until
+            all of them have arrived
+            """
+        if (self.body_level != self.level or
+                len(self.body_chunks) != self.body_count):
+            return None
+        return [(x / 16.0, y / 16.0, radius / 16.0)
+                for index in range(self.body_count)
+                for (x, y, radius) in self.body_chunks[index]]
+
+    def read_snapshot(self, data):
+        offset = PACKET.size
+        (snapshot, baseline_id, length, count) = SNAPSHOT_BODY.unpack_from(data, offset)
+        offset += SNAPSHOT_BODY.size
+        if baseline_id == 0xFFFF:
+            baseline = {}
+        elif baseline_id in self.snapshots:
+            baseline = self.snapshots[baseline_id]
+        else:
+            # Built on a snapshot we never got, wait for the next one
+            return
+        self.level = data[offset:offset + length].decode("utf-8")
+        offset += length
+
+        state = apply_delta(baseline, data, offset, count)
+        self.snapshots[snapshot] = state
+        self.snapshots.pop((snapshot - HISTORY) & 0xFFFF, None)
+        if self.latest is None or ((snapshot - self.latest) & 0xFFFF) < 0x8000:
+            self.latest = snapshot
+            self.state = state
+
+    def send_input(self, controls):
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        ack = self.latest if self.latest is not None else 0xFFFF
+        self.socket.sendto(PACKET.pack(INPUT) +
+                           INPUT_BODY.pack(self.sequence, ack, controls),
+                           self.address)
+        self.request_bodies()
+
+    def entities(self):
+        """ (entity id, kind, x, y, facing, scale, alive, life, score) for
+            each entity in the latest snapshot
+            """
+        for entity, values in self.state.items():
+            (kind, x, y, vx, vy, facing, flags, stats) = values
+            yield (entity, kind, x / 16.0, y / 16.0, facing * 360.0 / 65536,
+                   (flags & ~ALIVE) / 16.0, bool(flags & ALIVE),
+                   stats[0], stats[1])
+
+    def close(self):
+        try:
+            self.socket.sendto(PACKET.pack(DISCONNECT), self.address)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class NetGame(Scene):
+    """ Draws a Client's snapshots and sends the local player's keys """
+    images = {SHIP: ('ship.png', 40), STAR: ('sun.png', 50),
+              TORPEDO: ('torpedo.png', 6)}
+
+    def __init__(self, config, grid, client):
+        Scene.__init__(self, grid)
+        self.config = config
+        self.keys = config.keys
+        self.client = client
+        self.timestep = client.timestep
+        self.sprites = {}
+        self.level = None
+        # The level whose static bodies are on screen
+        self.body_level = None
+        self.scores = []
+
+    def sprite(self, entity, kind):
+        sprite = self.sprites.get(entity)
+        if sprite is None:
+            sprite = self.sprites[entity] = GLSprite()
+            (image, size) = self.images[kind]
+            if kind == SHIP and entity % 2:
+                image = 'ship2.png'
+            sprite.load_texture(image, 'images')
+            sprite.width = sprite.height = size
+            sprite.facing = 0.0
+        return sprite
+
+    def static_tick(self, interval):
+        for event in pygame.event.get():
+            if event.type == QUIT or (event.type == KEYDOWN and
+                                      event.key == K_ESCAPE):
+                self.running = False
+        if not self.running:
+            return
+
+        pressed = pygame.key.get_pressed()
+        keys = self.keys
+        controls = 0
+        for (name, bit) in (('forward', THRUST), ('reverse', REVERSE),
+                            ('right', RIGHT), ('left', LEFT), ('fire', FIRE)):
+            if pressed[keys[name + '_ship1']]:
+                controls |= bit
+        self.client.send_input(controls)
+        self.client.receive()
+        self.sync()
+
+    def sync(self):
+        """ Mirror the latest snapshot into the render and HUD groups """
+        client = self.client
+        if client.level and client.level != self.level:
+            self.level = client.level
+            level = LevelManager("levels").load(self.level)
+            self.g_background.empty()
+            self.g_background.add(Background(self.size, level.background))
+        if self.level and self.body_level != self.level:
+            bodies = client.static_bodies()
+            if bodies is not None:
+                self.body_level = self.level
+                if bodies:
+                    self.g_background.add(BodyField(client.size, {
+                        "bodies": [(x, y, radius, 0.0) for (x, y, radius) in bodies]}))
+
+        self.g_render.empty()
+        scores = []
+        for (entity, kind, x, y, facing, scale, alive,
+             life, score) in client.entities():
+            if kind == SHIP:
+                scores.append((entity, score))
+            if not alive:
+                continue
+            sprite = self.sprite(entity, kind)
+            sprite.x = x
+            sprite.y = y
+            sprite.facing = facing
+            sprite.scale = scale
+            self.g_render.add(sprite)
+
+        scores.sort()
+        if scores != self.scores:
+            self.scores = scores
+            self.g_hud.empty()
+            (width, height) = self.size
+            for index, (entity, score) in enumerate(scores):
+                x = 60 + index * (width - 120) / max(1, len(scores) - 1)
+                self.g_hud.add(GLText(score, x, height - 55, size=50))
+
+    def draw_screen(self, alpha = 1.0):
+        # Snapshots arrive without a previous state to blend from
+        Scene.draw_screen(self, 1.0)
+
+
+def loopback(clients = 2, seconds = 10.0, level = "level2", port = PORT,
+             drop_acks = 0.0):
+    """ Run a server and scripted clients on 127.0.0.1 and report traffic.
+
+        With drop_acks, each client goes quiet for a stretch of up to twice
+        HISTORY ticks with that chance every tick, so the server loses its
+        acks and has to fall back to a full snapshot. Every tick, each
+        client's rebuilt state is checked against what the server sent it:
+        "mismatches" counts the times they differed and "stalls" the times
+        a client was left a few snapshots behind, unable to apply the ones
+        it was getting.
+        """
+    server = Server(level, port = port, players = clients, host = "127.0.0.1",
+                    console = Quiet())
+    peers = [Client("127.0.0.1", port, "bot%d" % index) for index in range(clients)]
+    for peer in peers:
+        peer.socket.sendto(PACKET.pack(CONNECT) + peer.name.encode("utf-8"),
+                           peer.address)
+    server.receive()
+    rng = random.Random(1)
+    scripts = [THRUST | LEFT | FIRE, RIGHT | FIRE, THRUST | FIRE, LEFT | FIRE]
+    quiet = [0] * clients
+    remotes = dict((client.ship, client) for client in server.clients.values())
+    mismatches = 0
+    stalls = 0
+
+    interval = server.world.timestep / 1000.0
+    start = time.time()
+    ticks = 0
+    while time.time() - start < seconds and server.world.running:
+        tick_start = time.time()
+        for index, peer in enumerate(peers):
+            peer.receive()
+            remote = remotes.get(peer.ship)
+            if remote is not None and peer.latest in remote.sent:
+                if peer.state != remote.sent[peer.latest]:
+                    mismatches += 1
+            # Over loopback every snapshot sent so far has arrived
+            if server.snapshot and (peer.latest is None or
+                                    ((server.snapshot - peer.latest) & 0xFFFF) > 4):
+                stalls += 1
+            if rng.random() < 0.05:
+                scripts[index % len(scripts)] = rng.choice(
+                    [THRUST | LEFT | FIRE, RIGHT | FIRE, THRUST | FIRE, REVERSE | FIRE])
+            if quiet[index]:
+                quiet[index] -= 1
+                continue
+            if rng.random() < drop_acks:
+                quiet[index] = rng.randint(1, 2 * HISTORY)
+                continue
+            peer.send_input(scripts[index % len(scripts)])
+        server.tick()
+        ticks += 1
+        time.sleep(max(0.0, interval - (time.time() - tick_start)))
+
+    for peer in peers:
+        peer.receive()
+    report = {
+        "ticks": ticks,
+        "server_ms_per_tick": server.step_time * 1000.0 / max(1, ticks),
+        "clients": [{"bytes_per_tick": client.bytes_sent / float(max(1, client.packets_sent)),
+                     "packets": client.packets_sent}
+                    for client in server.clients.values()],
+        "entities_seen": [len(peer.state) for peer in peers],
+        "bodies_seen": [len(peer.static_bodies() or []) for peer in peers],
+        "mismatches": mismatches,
+        "stalls": stalls,
+    }
+    for peer in peers:
+        peer.close()
+    server.close()
+    return report
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest = "command")
+    serve = commands.add_parser("server", help = "run a headless server")
+    serve.add_argument("--level", default = "level1")
+    serve.add_argument("--port", type = int, default = PORT)
+    serve.add_argument("--players", type = int, default = 2)
+    serve.add_argument("--seed", type = match_seed)
+    join = commands.add_parser("client", help = "join a server")
+    join.add_argument("host")
+    join.add_argument("--port", type = int, default = PORT)
+    join.add_argument("--name", default = "")
+    test = commands.add_parser("loopback", help = "server and clients on 127.0.0.1")
+    test.add_argument("--clients", type = int, default = 2)
+    test.add_argument("--seconds", type = float, default = 10.0)
+    test.add_argument("--level", default = "level2")
+    test.add_argument("--port", type = int, default = PORT)
+    test.add_argument("--drop-acks", type = float, default = 0.0, metavar = "CHANCE",
+                      help = "chance each tick that a client stops acking for a while; "
+                             "exits with 1 if any client then falls out of step")
+    options = parser.parse_args(argv)
+
+    if options.command == "server":
+        try:
+            server = Server(options.level, port = options.port,
+                            players = options.players, seed = options.seed)
+        except ValueError as error:
+            parser.error(str(error))
+        try:
+            server.serve()
+        finally:
+            server.close()
+    elif options.command == "client":
+        from spacewar import init, resize
+        from lava.config import ConfigManager
+
+        client = Client(options.host, options.port, options.name)
+        if not client.connect():
+            sys.exit("No answer from %s:%d" % client.address)
+        pygame.init()
+        config = ConfigManager(filename = 'spacewar.cfg')
+        pygame.display.set_mode(config.resolution, OPENGL | DOUBLEBUF)
+        pygame.display.set_caption('Spacewar Type-R')
+        grid = resize(config.resolution)
+        init()
+        game = NetGame(config, grid, client)
+        try:
+            game.run()
+        finally:
+            client.close()
+    elif options.command == "loopback":
+        import json
+        try:
+            report = loopback(options.clients, options.seconds, options.level,
+                              options.port, options.drop_acks)
+        except ValueError as error:
+            parser.error(str(error))
+        print(json.dumps(report, indent = 2))
+        if report["mismatches"] or report["stalls"]:
+            return 1
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+""" Record matches as compact input logs and replay them headless.
+
+A log holds the world's seed and starting level, then one record for
+every step where a ship's control bits changed or a discrete action
+(restart, kill, scale, blend) happened, and ends with the step count and
+a digest of the final world state. Replaying feeds the same inputs
+through a World as fast as the CPU allows and checks the digest, so a
+change that alters gameplay shows up as a mismatch.
+
+    python replay.py match.rec
+"""
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import sys
+import time
+import struct
+import argparse
+from actors import Console, Quiet
+from world import World
+
+MAGIC = b"SWR1"
+# seed, timestep, width, height, ships, length of the level name
+HEADER = struct.Struct("<IHHHBB")
+# steps since the previous record, number of actions (END closes the log)
+RECORD = struct.Struct("<HB")
+ACTION = struct.Struct("<BB")
+END = 0xFF
+DIGEST_SIZE = 20
+
+
+class Recorder(object):
+    """ Writes the inputs a World receives to a replay log """
+    def __init__(self, filename, world):
+        self.ships = len(world.ships)
+        self.last_tick = 0
+        self.controls = None
+        self.actions = []
+
+        # Packed first, so a world the header can't hold leaves no file
+        level = world.level_file.encode("utf-8")
+        header = HEADER.pack(world.seed, world.timestep, world.size[0],
+                             world.size[1], self.ships, len(level))
+        self.file = open(filename, "wb")
+        self.file.write(MAGIC)
+        self.file.write(header)
+        self.file.write(level)
+
+    def action(self, action, index = 0):
+        """ Note a discrete action performed before the next step """
+        self.actions.append((action, index))
+
+    def tick(self, world):
+        """ Record the inputs for the step the world is about to take """
+        controls = bytes(bytearray(ship.controls for ship in world.ships))
+        if controls == self.controls and not self.actions:
+            return
+
+        self.file.write(RECORD.pack(self.advance(world.ticks), len(self.actions)))
+        self.file.write(controls)
+        for (action, index) in self.actions:
+            self.file.write(ACTION.pack(action, index))
+        self.controls = controls
+        self.actions = []
+
+    def advance(self, tick):
+        """ Steps from the last record to tick, padding the log with
+            unchanged records where that is too many for one record
+            """
+        delta = tick - self.last_tick
+        while delta > 0xFFFF:
+            self.file.write(RECORD.pack(0xFFFF, 0))
+            self.file.write(self.controls)
+            delta -= 0xFFFF
+        self.last_tick = tick
+        return delta
+
+    def close(self, world):
+        self.file.write(RECORD.pack(self.advance(world.ticks), END))
+        self.file.write(world.digest())
+        self.file.close()
+
+
+class ReplayLog(object):
+    """ A replay log read back into memory """
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            data = f.read()
+        if data[:4] != MAGIC:
+            raise ValueError("%s is not a replay log" % filename)
+
+        offset = 4
+        (self.seed, self.timestep, width, height, ships,
+         length) = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        self.size = (width, height)
+        self.ships = ships
+        self.level = data[offset:offset + length].decode("utf-8")
+        offset += length
+
+        # (tick, controls, actions) for every record, in order
+        self.records = []
+        tick = 0
+        while True:
+            (delta, count) = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            tick += delta
+            if count == END:
+                self.ticks = tick
+                self.digest = data[offset:offset + DIGEST_SIZE]
+                break
+            controls = bytearray(data[offset:offset + ships])
+            offset += ships
+            actions = [ACTION.unpack_from(data, offset + ACTION.size * i)
+                       for i in range(count)]
+            offset += ACTION.size * count
+            self.records.append((tick, controls, actions))
+
+
+def replay(log, console = None):
+    """ Run log through a fresh World as fast as possible, return the world """
+    names = ["Player %d" % (i + 1) for i in range(log.ships)]
+    world = World(log.size, log.level, names, console = console or Quiet(),
+                  seed = log.seed)
+    world.timestep = log.timestep
+    records = iter(log.records)
+    record = next(records, None)
+    controls = bytearray(log.ships)
+
+    while world.ticks < log.ticks and world.running:
+        if record is not None and record[0] == world.ticks:
+            (tick, controls, actions) = record
+            for (action, index) in actions:
+                world.perform(action, index)
+            record = next(records, None)
+        # Controls hold between records, including onto the new ships
+        # of a freshly loaded level
+        for ship, bits in zip(world.ships, controls):
+            ship.controls = bits
+        world.step()
+    return world
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("log", help = "replay log written with --record")
+    parser.add_argument("-v", "--verbose", action = "store_true",
+                        help = "print the match's console messages")
+    options = parser.parse_args(argv)
+
+    log = ReplayLog(options.log)
+    console = Console() if options.verbose else None
+    start = time.perf_counter()
+    world = replay(log, console)
+    elapsed = time.perf_counter() - start
+
+    print("%d steps in %.2f s (%d steps/s)" %
+          (world.ticks, elapsed, world.ticks / max(elapsed, 1e-9)))
+    if world.digest() == log.digest:
+        print("final state matches the recording")
+    else:
+        print("final state DIFFERS from the recording")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
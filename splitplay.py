@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+""" Simulation and rendering in separate processes.
+
+A worker process steps the World in real time and publishes what there
+is to draw into a double-buffered multiprocessing.shared_memory block;
+the game process only reads keys, draws and flips. Neither half waits on
+the other's frame or holds the other's GIL.
+
+Each buffer has a sequence number that is odd while the worker writes it
+(a seqlock). The renderer draws straight from numpy views of the newest
+even buffer and checks the number again before submitting, so it never
+copies, pickles or draws a half-written state. Entities are published in
+runs sharing a texture, so each run is one SpriteBatch call. A level's
+static bodies never move, so they are published once when the level is
+loaded, under a sequence number of their own.
+
+The game process writes the human players' control bits into the block's
+header for the worker to pick up, and counts each discrete action it asks
+for there, so none is lost when several come in one frame.
+
+    python spacewar.py --split --bots 6
+"""
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy
+from actors import *
+from world import World, RESTART, KILL, SCALE
+from bots import BotController, bot_names
+from lava.levels import LevelManager
+from lava.pacer import FramePacer
+
+CAPACITY = 8192
+MAX_RUNS = 32
+MAX_BODIES = 8192
+MAX_SHIPS = 64
+MAX_PLAYERS = 2
+# x, y, facing, scale, width, height, alpha
+COLUMNS = 7
+
+HEADER = numpy.dtype([
+    ("front", "<u4"),
+    ("running", "<u4"),
+    # Bumped whenever the worker loads a level
+    ("level_serial", "<u4"),
+    ("level", "S64"),
+    ("controls", "u1", (MAX_PLAYERS,)),
+    # How many times the game has asked for each action, by ship index
+    ("actions", "<u4", (SCALE + 1, MAX_PLAYERS)),
+    # Texture paths, newline separated; a run's texture is an index into it
+    ("textures", "S1024"),
+    # Odd while the worker writes a level's static bodies
+    ("bodies_sequence", "<u4"),
+    ("bodies_count", "<u4"),
+    ("bodies_texture", "<i4"),
+])
+
+BUFFER = numpy.dtype([
+    ("sequence", "<u8"),
+    ("tick", "<u8"),
+    ("count", "<u4"),
+    ("runs", "<u4"),
+    # texture id, first entity, entity count
+    ("run", "<i4", (MAX_RUNS, 3)),
+    ("ships", "<u4"),
+    ("scores", "<i4", (MAX_SHIPS,)),
+    ("alive", "u1", (MAX_SHIPS,)),
+    ("entities", "<f8", (CAPACITY, COLUMNS)),
+])
+
+BLOCK = numpy.dtype([("header", HEADER),
+                     # x, y and drawn width of each static body
+                     ("bodies", "<f8", (MAX_BODIES, 3)),
+                     ("buffers", BUFFER, (2,))])
+
+
+class SharedState(object):
+    """ The shared memory block, created by the game and attached to by
+        the worker by name
+        """
+    def __init__(self, name = None):
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create = True,
+                                                     size = BLOCK.itemsize)
+        else:
+            self.memory = shared_memory.SharedMemory(name = name)
+        self.name = self.memory.name
+        block = numpy.ndarray((), dtype = BLOCK, buffer = self.memory.buf)
+        self.header = block["header"]
+        self.bodies = block["bodies"]
+        self.buffers = [block["buffers"][0], block["buffers"][1]]
+        self.textures = []
+        self.texture_ids = {}
+
+    def texture_id(self, key):
+        """ The index of a texture in the header's table, adding it if new """
+        try:
+            return self.texture_ids[key]
+        except KeyError:
+            path = os.path.join(textures.sources[key], key)
+            self.textures.append(path)
+            self.header["textures"] = "\n".join(self.textures).encode("utf-8")
+            texture = self.texture_ids[key] = len(self.textures) - 1
+            return texture
+
+    def publish(self, world):
+        """ Write the world into the back buffer and make it the front """
+        back = 1 - int(self.header["front"])
+        buffer = self.buffers[back]
+        buffer["sequence"] += 1
+
+        runs = {}
+        for sprite in world.g_render:
+            if type(sprite).draw is GLSprite.draw:
+                runs.setdefault((sprite.texture, 1.0), []).append(
+                    (sprite.x, sprite.y, sprite.facing, sprite.scale,
+                     sprite.width, sprite.height, 1.0))
+        entities = buffer["entities"]
+        run = buffer["run"]
+        count = 0
+        for index, ((texture, alpha), rows) in enumerate(list(runs.items())[:MAX_RUNS - 1]):
+            rows = rows[:CAPACITY - count]
+            entities[count:count + len(rows)] = rows
+            run[index] = (self.texture_id(texture), count, len(rows))
+            count += len(rows)
+        buffer["runs"] = min(len(runs), MAX_RUNS - 1)
+        count = self.publish_particles(world.particles, buffer, count)
+
+        ships = world.ships[:MAX_SHIPS]
+        buffer["ships"] = len(ships)
+        buffer["scores"][:len(ships)] = [ship.score for ship in ships]
+        buffer["alive"][:len(ships)] = [ship.alive() for ship in ships]
+        buffer["count"] = count
+        buffer["tick"] = world.ticks
+
+        buffer["sequence"] += 1
+        self.header["front"] = back
+
+    def publish_bodies(self, field):
+        """ Write a newly loaded level's static bodies, or none if field is
+            None. Called before the level is announced in the header
+            """
+        header = self.header
+        header["bodies_sequence"] += 1
+        count = 0
+        if field is not None:
+            bodies = field.bodies.bodies[:MAX_BODIES]
+            count = len(bodies)
+            self.bodies[:count, 0:2] = bodies[:, 0:2]
+            self.bodies[:count, 2] = bodies[:, 2] * field.width_per_radius
+            header["bodies_texture"] = self.texture_id(field.texture)
+        header["bodies_count"] = count
+        header["bodies_sequence"] += 1
+
+    def latest_bodies(self):
+        """ (texture id, rows) for the static bodies, copied out """
+        header = self.header
+        while True:
+            sequence = int(header["bodies_sequence"])
+            if sequence % 2:
+                continue
+            texture = int(header["bodies_texture"])
+            rows = self.bodies[:int(header["bodies_count"])].copy()
+            if int(header["bodies_sequence"]) == sequence:
+                return (texture, rows)
+
+    def publish_particles(self, particles, buffer, count):
+        number = min(particles.count, CAPACITY - count)
+        if number <= 0 or particles.texture is None:
+            return count
+        rows = buffer["entities"][count:count + number]
+        rows[:, 0:2] = particles.position[:number]
+        rows[:, 2] = particles.facings[:number]
+        rows[:, 3] = particles.scales[:number]
+        rows[:, 4] = particles.sizes[:number]
+        rows[:, 5] = particles.sizes[:number]
+        # Particles are drawn half transparent
+        rows[:, 6] = 0.5
+        runs = int(buffer["runs"])
+        buffer["run"][runs] = (self.texture_id(particles.texture), count, number)
+        buffer["runs"] = runs + 1
+        return count + number
+
+    def latest(self):
+        """ (buffer, sequence) of the newest completely written buffer """
+        while True:
+            buffer = self.buffers[int(self.header["front"])]
+            sequence = int(buffer["sequence"])
+            if not sequence % 2:
+                return (buffer, sequence)
+
+    def texture_paths(self):
+        return self.header["textures"].item().decode("utf-8").split("\n")
+
+    def close(self):
+        self.header = self.bodies = self.buffers = None
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+
+def simulate(name, size, level, names, seed, bots):
+    """ The worker process: step a World in real time into SharedState """
+    state = SharedState(name)
+    header = state.header
+    world = World(size, level, names, Console(), seed = seed)
+    controllers = []
+    if bots:
+        controllers.append(BotController(range(MAX_PLAYERS, MAX_PLAYERS + bots)))
+    pacer = FramePacer(1000.0 / world.timestep)
+    performed = numpy.zeros_like(header["actions"])
+    level_name = None
+    try:
+        while header["running"]:
+            if world.level_file != level_name:
+                level_name = world.level_file
+                state.publish_bodies(world.bodies)
+                header["level"] = level_name.encode("utf-8")
+                header["level_serial"] += 1
+
+            for ship, bits in zip(world.ships, header["controls"].tolist()):
+                ship.controls = bits
+            requested = header["actions"].copy()
+            missed = requested - performed
+            for (action, index) in zip(*numpy.nonzero(missed)):
+                for i in range(int(missed[action, index])):
+                    world.perform(int(action), int(index))
+            performed = requested
+            [controller.steer(world) for controller in controllers]
+
+            world.step()
+            if not world.running:
+                break
+            state.publish(world)
+            pacer.wait()
+    finally:
+        header["running"] = 0
+        state.close()
+
+
+class SplitGame(Scene):
+    """ Draws the worker's published state and feeds it the keyboard """
+    def __init__(self, config, grid, level_file, seed = None, bots = 0):
+        Scene.__init__(self, grid)
+        self.config = config
+        self.keys = config.keys
+        self.grid = grid
+        self.names = [config.player1_name, config.player2_name]
+        self.pacer = FramePacer(config.target_fps)
+        self.render_on_step = config.render_on_step
+
+        self.state = SharedState()
+        self.state.header["running"] = 1
+        self.worker = multiprocessing.Process(
+            target = simulate, name = "simulation",
+            args = (self.state.name, grid, level_file,
+                    self.names + bot_names(bots),
+                    seed, bots))
+        self.worker.start()
+
+        self.level_serial = 0
+        self.paths = []
+        self.score_texts = []
+        # (texture id, vertices) for the level's static bodies
+        self.bodies = None
+
+    def static_tick(self, interval):
+        header = self.state.header
+        for event in pygame.event.get():
+            if event.type == QUIT or (event.type == KEYDOWN and
+                                      event.key == K_ESCAPE):
+                self.running = False
+            elif event.type == KEYDOWN:
+                self.handle_key(event.key)
+        if not header["running"]:
+            self.running = False
+        if not self.running:
+            return
+
+        pressed = pygame.key.get_pressed()
+        for index, player in enumerate(('ship1', 'ship2')):
+            header["controls"][index] = self.read_controls(pressed, player)
+        if int(header["level_serial"]) != self.level_serial:
+            self.load_scenery()
+        self.update_scores()
+
+    def handle_key(self, key):
+        keys = self.keys
+        actions = {keys['restart']: (RESTART, 0),
+                   keys['kill_ship1']: (KILL, 0), keys['kill_ship2']: (KILL, 1),
+                   keys['scale_ship1']: (SCALE, 0), keys['scale_ship2']: (SCALE, 1)}
+        if key in actions:
+            self.state.header["actions"][actions[key]] += 1
+
+    def read_controls(self, pressed, ship):
+        keys = self.keys
+        controls = 0
+        for (name, bit) in (('forward_', THRUST), ('reverse_', REVERSE),
+                            ('right_', RIGHT), ('left_', LEFT), ('fire_', FIRE)):
+            if pressed[keys[name + ship]]:
+                controls |= bit
+        return controls
+
+    def load_scenery(self):
+        header = self.state.header
+        self.level_serial = int(header["level_serial"])
+        level = LevelManager("levels").load(header["level"].item().decode("utf-8"))
+        (width, height) = self.grid
+
+        self.g_background.empty()
+        self.g_background.add(Background(self.grid, level.background))
+        self.g_hud.empty()
+        self.g_hud.add(GLText(self.names[0], 20, height - 20, halign='left'),
+                       GLText(self.names[1], width - 20, height - 20, halign='right'))
+        self.score_texts = [GLText(0, 20, height - 55, size=50),
+                            GLText(0, width - 20, height - 55, size=50)]
+        self.g_hud.add(*self.score_texts)
+
+        (texture, rows) = self.state.latest_bodies()
+        self.bodies = None
+        if len(rows):
+            count = len(rows)
+            self.bodies = (texture, self.g_render.batch.vertices(
+                rows[:, 0], rows[:, 1], numpy.zeros(count), numpy.ones(count),
+                rows[:, 2], rows[:, 2]))
+        textures.purge()
+
+    def update_scores(self):
+        while True:
+            (buffer, sequence) = self.state.latest()
+            scores = buffer["scores"][:MAX_PLAYERS].tolist()
+            if int(buffer["sequence"]) == sequence:
+                break
+        for text, score in zip(self.score_texts, scores):
+            text.update_string(score)
+
+    def draw_entities(self):
+        """ Draw the newest buffer, retrying if the worker overtook us """
+        state = self.state
+        while True:
+            (buffer, sequence) = state.latest()
+            entities = buffer["entities"]
+            batches = []
+            for (texture, start, count) in buffer["run"][:int(buffer["runs"])].tolist():
+                rows = entities[start:start + count]
+                batches.append((texture, rows[0, 6] if count else 1.0,
+                                self.g_render.batch.vertices(*rows[:, :6].T)))
+            if int(buffer["sequence"]) == sequence:
+                break
+        # Under everything else, as in the World
+        if self.bodies is not None:
+            (texture, vertices) = self.bodies
+            batches.insert(0, (texture, 1.0, vertices))
+
+        used = max([texture + 1 for (texture, alpha, vertices) in batches] or [0])
+        if used > len(self.paths):
+            # Pick up textures the worker started using. Entries past the
+            # ones this buffer uses may still be being written
+            paths = state.texture_paths()[:used]
+            for path in paths[len(self.paths):]:
+                (directory, file) = os.path.split(path)
+                textures.acquire(file, directory)
+            self.paths = paths
+        paths = self.paths
+        for (texture, alpha, vertices) in batches:
+            if alpha < 1.0:
+                glColor(1.0, 1.0, 1.0, alpha)
+            self.g_render.batch.submit(textures.get(os.path.basename(paths[texture])),
+                                       vertices)
+            if alpha < 1.0:
+                glColor(1.0, 1.0, 1.0, 1.0)
+
+    def draw_screen(self, alpha = 1.0):
+        self.target.begin()
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        self.g_background.draw()
+        self.draw_entities()
+        self.g_hud.draw()
+        self.profiler.mark("draw")
+        self.target.present()
+        self.profiler.mark("flip")
+
+    def close(self):
+        self.state.header["running"] = 0
+        self.worker.join(5.0)
+        if self.worker.is_alive():
+            self.worker.terminate()
+        self.state.close()
+        self.state.unlink()
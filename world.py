@@ -0,0 +1,449 @@
+import math
+import random
+import argparse
+import struct
+import hashlib
+from actors import *
+from lava.levels import LevelManager
+from lava.physics import GravityField, SpatialHash, gravitate, swept_collide, wrapped_collide
+from lava.profiler import FrameProfiler
+
+
+# Seeds are below this: replay logs store them in 32 bits, and numpy takes
+# no negative ones
+SEEDS = 2 ** 32
+
+
+def match_seed(text):
+    """ A seed from the command line, in the range a World accepts """
+    seed = int(text)
+    if not 0 <= seed < SEEDS:
+        raise argparse.ArgumentTypeError("a seed is from 0 to %d, not %d" % (SEEDS - 1, seed))
+    return seed
+
+
+# Discrete actions, see World.perform()
+RESTART = 1
+KILL = 2
+SCALE = 3
+BLEND = 4
+
+
+class World(object):
+    """ The game simulation without any display or GL dependency.
+
+        Ships, torpedoes, stars and collisions advance by a fixed timestep
+        on a simulated clock (self.time, in ms), so the same match plays out
+        the same way whatever the frame rate, and can run faster than real
+        time when nothing is drawing it.
+
+        There is one ship per name in player_names, at least two.
+        """
+    timestep = 25
+    # Steps between collision passes, made up for by sweeping fast movers
+    collision_interval = 1
+    ship_images = ('ship.png', 'ship2.png')
+
+    def __init__(self, size, level_file, player_names = ("Player 1", "Player 2"),
+                 console = None, levels = "levels", seed = None):
+        if seed is None:
+            seed = random.getrandbits(32)
+        if not 0 <= seed < SEEDS:
+            raise ValueError("seed %d is out of range" % seed)
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.size = size
+        self.lm = LevelManager(levels)
+        self.player_names = player_names
+        self.console = console or Console()
+        self.running = True
+        self.time = 0
+        self.ticks = 0
+        self.last_pass = -1
+        self.level = None
+        self.level_file = None
+        self.spawn_points = list()
+        self.ships = list()
+        # The level's indexed static bodies, if it has any
+        self.bodies = None
+
+        self.entities = EntityStore()
+        self.g_stars = GLSpriteGroup(store = self.entities)
+        self.g_ships = GLSpriteGroup(store = self.entities)
+        self.g_collision = GLSpriteGroup(store = self.entities)
+        self.g_render = GLSpriteGroup(store = self.entities)
+        self.particles = ParticleSystem(seed = seed)
+        self.torpedoes = TorpedoPool()
+        self.broadphase = SpatialHash(size)
+        self.field = GravityField(size)
+        self.profiler = FrameProfiler()
+        # What happens when two types of sprite touch, see collide()
+        self.handlers = {(Ship, Ship): self.crash,
+                         (Ship, Torpedo): self.shot,
+                         (Star, Ship): self.burn,
+                         (Star, Torpedo): self.quench,
+                         (Obstacle, Ship): self.burn,
+                         (Obstacle, Torpedo): self.quench}
+        # The parts of a step, in order, named for profiling
+        self.phases = [("input", self.steer),
+                       ("gravity", self.gravity),
+                       ("update", self.move),
+                       ("collision", self.collisions)]
+        self.load_level(level_file)
+
+    def step(self):
+        """ Advance the world by one timestep """
+        interval = self.timestep
+        self.time += interval
+        self.ticks += 1
+
+        profiler = self.profiler
+        for (name, phase) in self.phases:
+            phase(interval)
+            profiler.mark(name)
+
+    def steer(self, interval):
+        [self.control(ship, interval) for ship in self.ships]
+        [self.remember(sprite) for sprite in self.g_render]
+
+    def gravity(self, interval):
+        """ Stars that stay put pull through the cached field, moving ones
+            are worked out directly
+            """
+        fixed = []
+        moving = []
+        for star in self.g_stars:
+            if star.vx or star.vy:
+                moving.append(star)
+            else:
+                fixed.append(star)
+        self.field.gravitate(fixed, self.g_collision, interval)
+        gravitate(moving, self.g_collision, interval)
+        if self.bodies is not None:
+            self.bodies.gravitate(self.g_collision, interval)
+
+    def move(self, interval):
+        self.g_render.update(interval)
+        [self.check_bounds(sprite) for sprite in self.g_collision]
+
+    def collisions(self, interval):
+        if self.ticks % self.collision_interval:
+            return
+        padding = self.sweep(self.g_collision)
+        self.broadphase.rebuild(self.g_collision, padding)
+        [self.world_collision(sprite) for sprite in self.g_ships]
+        [self.world_collision(sprite) for sprite in self.g_stars]
+        if self.bodies is not None:
+            [self.collide(obstacle, sprite)
+             for (obstacle, sprite) in self.bodies.hits(self.g_collision)
+             if sprite.alive()]
+
+    def sweep(self, sprites):
+        """ Note how far each sprite moved since the last collision pass,
+            or since it was launched or respawned if that came after, and
+            flag the ones that moved further than their own radius as fast.
+            Sprites with no such start sweep over the last step. Returns how
+            much wider the broadphase has to look to catch any two of them
+            """
+        (width, height) = self.size
+        longest = 0.0
+        for sprite in sprites:
+            if sprite.sweep_tick is not None and sprite.sweep_tick >= self.last_pass:
+                (x, y) = (sprite.sweep_x, sprite.sweep_y)
+                sprite.sweep_span = self.ticks - sprite.sweep_tick
+            else:
+                (x, y) = (sprite.prev_x, sprite.prev_y)
+                sprite.sweep_span = 1
+            dx = (sprite.x - x + width / 2) % width - width / 2
+            dy = (sprite.y - y + height / 2) % height - height / 2
+            moved = dx * dx + dy * dy
+            sprite.sweep_dx = dx
+            sprite.sweep_dy = dy
+            sprite.fast = moved > sprite.scaled_radius * sprite.scaled_radius
+            sprite.sweep_x = sprite.x
+            sprite.sweep_y = sprite.y
+            sprite.sweep_tick = self.ticks
+            if moved > longest:
+                longest = moved
+        self.last_pass = self.ticks
+        return 2 * math.sqrt(longest)
+
+    def start_sweep(self, sprite):
+        """ Sweep sprite from where it is now at the next collision pass.
+            Called during a step, before the sprite moves in it
+            """
+        sprite.sweep_x = sprite.x
+        sprite.sweep_y = sprite.y
+        sprite.sweep_tick = self.ticks - 1
+
+    def remember(self, sprite):
+        sprite.prev_x = sprite.x
+        sprite.prev_y = sprite.y
+        sprite.prev_facing = sprite.facing
+
+    def control(self, ship, interval):
+        """ Apply the ship's control bits for this step """
+        controls = ship.controls
+        if controls & THRUST:
+            ship.thrust(interval)
+        elif controls & REVERSE:
+            ship.reverse_thrust(interval)
+        if controls & RIGHT:
+            ship.rotate(-1)
+        elif controls & LEFT:
+            ship.rotate(1)
+        else:
+            ship.rotate(0)
+        if controls & FIRE:
+            if ship.alive():
+                ship.fire()
+            else:
+                self.respawn(ship)
+
+    def perform(self, action, index = 0):
+        """ Apply a discrete action to the world, or to ship number index """
+        if action == RESTART:
+            self.restart()
+        elif action == KILL:
+            ship = self.ships[index]
+            ship.kill()
+            ship.score -= 1
+        elif action == SCALE:
+            ship = self.ships[index]
+            if ship.scale == 1.0:
+                ship.scale = 2.0
+            else:
+                ship.scale = 1.0
+
+    def digest(self):
+        """ Hash of the simulation state, equal only for identical matches """
+        state = hashlib.sha1()
+        state.update(struct.pack("<qq", self.time, self.ticks))
+        for ship in self.ships:
+            state.update(struct.pack("<5d2i", ship.x, ship.y, ship.vx, ship.vy,
+                                     ship.facing, ship.score, ship.life))
+        for sprite in self.g_collision:
+            state.update(struct.pack("<4d", sprite.x, sprite.y,
+                                     sprite.vx, sprite.vy))
+        return state.digest()
+
+    def world_collision(self, sprite1):
+        """ Test sprite1 against the g_collision sprites in nearby cells """
+        [self.detect_collision(sprite1, sprite2)
+         for sprite2 in self.broadphase.query(sprite1)]
+
+    def detect_collision(self, sprite1, sprite2):
+        # Pairs that can never interact, before any distance math
+        if not sprite1.mask & sprite2.layer:
+            return
+        if sprite1 is sprite2 or sprite1.ignore is sprite2 or sprite2.ignore is sprite1:
+            return
+
+        # Something earlier in this pass may already have destroyed either
+        if not (sprite1.alive() and sprite2.alive()):
+            return
+
+        if sprite1.fast or sprite2.fast:
+            if swept_collide(sprite1, sprite2, self.size):
+                self.collide(sprite1, sprite2)
+        elif wrapped_collide(sprite1, sprite2, self.size):
+            self.collide(sprite1, sprite2)
+
+    def collide(self, entity1, entity2):
+        """ Perform different actions depending on what is colliding, as
+            given by the handlers table for their types. Subclasses use
+            the nearest entry for their bases
+            """
+        key = (type(entity1), type(entity2))
+        try:
+            handler = self.handlers[key]
+        except KeyError:
+            handler = self.handlers[key] = self.find_handler(*key)
+        if handler is not None:
+            handler(entity1, entity2)
+
+    def find_handler(self, type1, type2):
+        for base1 in type1.__mro__:
+            for base2 in type2.__mro__:
+                if (base1, base2) in self.handlers:
+                    return self.handlers[(base1, base2)]
+        return None
+
+    def crash(self, entity1, entity2):
+        entity1.score -= 1
+        entity2.score -= 1
+        self.console.event("crash", "%s and %s got a little too close" % (entity1.name, entity2.name),
+                           ships=[entity1.name, entity2.name])
+        entity1.kill()
+        entity2.kill()
+
+    def shot(self, entity1, entity2):
+        entity1.take_damage(entity2)
+        attacker = entity2.parent
+        entity2.kill()
+        del entity2
+        self.console.event("hit", "%s was attacked by %s" % (entity1.name, attacker.name),
+                           ship=entity1.name, attacker=attacker.name,
+                           life=entity1.life)
+
+        if not entity1.alive():
+            if entity1 is attacker:
+                self.console.event("suicide", "%s ends it all." % entity1.name,
+                                   ship=entity1.name)
+                entity1.score -= 1
+                if entity1.score <= -10:
+                    self.won(attacker)
+            else:
+                self.console.event("kill", "%s was shot down by %s" % (entity1.name, attacker.name),
+                                   ship=entity1.name, attacker=attacker.name)
+                attacker.score += 1
+                if attacker.score >= 10 or entity1.score <= -10:
+                    self.won(attacker)
+
+    def burn(self, star, ship):
+        ship.kill()
+        self.console.event("lava", "%s did a backflip into the lava" % (ship.name),
+                           ship=ship.name)
+        ship.score -= 1
+        if ship.score <= -10:
+            self.console.event("out", "%s is done" % ship.name,
+                               ship=ship.name)
+            self.load_level(self.level.next_level)
+
+    def quench(self, star, torpedo):
+        torpedo.kill()
+
+    def won(self, ship):
+        self.console.event("win", "%s WON!" % ship.name, ship=ship.name,
+                           scores=dict((each.name, each.score) for each in self.ships))
+        self.load_level(self.level.next_level)
+
+    def check_bounds(self, sprite):
+        if sprite.x > self.size[0]:
+            sprite.x -= self.size[0]
+        elif sprite.x < 0:
+            sprite.x += self.size[0]
+        if sprite.y > self.size[1]:
+            sprite.y -= self.size[1]
+        elif sprite.y < 0:
+            sprite.y += self.size[1]
+
+    def respawn(self, player):
+        x = self.random.randrange(0, len(self.spawn_points))
+        # Move along the point's rows rather than onto another ship
+        for slot in range(len(self.ships)):
+            self.place(player, self.spawn_points[x], slot)
+            if not [ship for ship in self.g_ships
+                    if wrapped_collide(player, ship, self.size)]:
+                break
+
+        player.life = player.max_life
+        self.start_sweep(player)
+        self.g_ships.add(player)
+        self.g_render.add(player)
+        self.g_collision.add(player)
+
+    def level_images(self, level):
+        """ (file, directory) of every image level needs beyond the ships """
+        images = [(level.background, '')]
+        for entity_data in level.static_entities.values():
+            if entity_data['class'] == "Star":
+                images.append((Star.image, 'images'))
+        if level.static_bodies:
+            images.append((BodyField.image, 'images'))
+        return images
+
+    def restart(self):
+        self.load_level(self.level_file)
+
+    def load_level(self, level_file):
+        if not level_file:
+            self.running = False
+            return
+
+        (width, height) = self.size
+
+        self.g_stars.empty()
+        self.g_ships.empty()
+        self.g_collision.empty()
+        self.g_render.empty()
+        self.particles.clear()
+        self.torpedoes.reset()
+
+        self.level = self.lm.load(level_file)
+        self.level_file = level_file
+        self.console.event("level", "Working with level file %s" % self.level.file,
+                           level=level_file)
+
+        # load the static sprites from the level def
+        for static_entity_name in self.level.static_entities:
+            entity_data = self.level.static_entities[static_entity_name]
+
+            # specific routines for different classes
+            if entity_data['class'] == "Star":
+                if entity_data['pos_x'] == "center":
+                    x = width / 2
+                else:
+                    x = entity_data['pos_x']
+
+                if entity_data['pos_y'] == "center":
+                    y = height / 2
+                else:
+                    y = entity_data['pos_y']
+
+                entity = Star(self, x, y)
+                entity.vx = entity_data['vel_x']
+                entity.vy = entity_data['vel_y']
+                self.g_stars.add(entity)
+
+            self.g_collision.add(entity)
+            self.g_render.add(entity)
+
+        self.bodies = None
+        if self.level.static_bodies:
+            self.bodies = BodyField(self.size, self.level.static_bodies)
+            self.g_render.add(self.bodies)
+
+        # load spawn points from level def
+        self.spawn_points = list()
+        for spawn_point_name in self.level.spawn_points:
+            spawn_point = self.level.spawn_points[spawn_point_name]
+            self.spawn_points.append(SpawnPoint(spawn_point['pos_x'], spawn_point['pos_y'], spawn_point['facing']))
+
+        # load up ships, one per player name
+        self.ships = [Ship(self, name = name, image = self.ship_images[i % 2])
+                      for i, name in enumerate(self.player_names)]
+        (self.ship1, self.ship2) = self.ships[:2]
+
+        self.g_ships.add(*self.ships)
+        self.g_collision.add(*self.ships)
+        self.g_render.add(*self.ships)
+        self.g_render.add(self.particles)
+
+        for i, ship in enumerate(self.ships):
+            self.spawn(ship, i)
+        [self.remember(sprite) for sprite in self.g_render]
+
+    def spawn(self, ship, index):
+        """ Place ship number index at the start of a level.
+
+            The first two ships take the first and last spawn points, as
+            they always have, and later ones the points in between. Once
+            every point is taken, further ships line up in rows leading
+            away from the edge each point sits on, see place().
+            """
+        points = self.spawn_points
+        order = [0, len(points) - 1] + list(range(1, len(points) - 1))
+        self.place(ship, points[order[index % len(points)]], index // len(points))
+
+    def place(self, ship, point, slot):
+        """ Spawn ship at point, or slot places along its rows """
+        point.spawn(ship)
+        if not slot:
+            return
+
+        row, column = divmod(slot - 1, 8)
+        spacing = 2.5 * ship.scaled_radius
+        ship.x += spacing * (column + 1) * (1 if point.x >= 0 else -1)
+        ship.y += spacing * row * (1 if point.y >= 0 else -1)
+        self.check_bounds(ship)